@@ -0,0 +1,93 @@
+"""Event loop lag while many compressions run their local (CPU-bound) steps.
+
+Each simulated compression waits on a fake network round-trip, then does the
+work the pipeline does locally between LLM calls: counting tokens, running
+static regexes over the prompt and decoding a large JSON response. A ticker
+task measures how late the loop wakes it up.
+
+    python benchmarks/loop_lag.py --concurrency 32 --executor none thread process
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from compress_gpt.compress import extract_statics
+from compress_gpt.executor import offload, set_executor
+from compress_gpt.prompts.compress_chunks import Chunk
+from compress_gpt.prompts.output_parser import decode
+from compress_gpt.utils import count_tokens
+
+TICK = 0.005
+
+PROMPT = "\n".join(
+    f"- Rule {i}: use the `calendar` tool to schedule meetings on 2023-04-{i % 28 + 1:02d} "
+    "and confirm the attendees before sending any invitation."
+    for i in range(400)
+)
+RESPONSE = json.dumps(
+    [
+        {"m": "c", "t": f"rule {i}: cal tool->sched mtg, confirm attendees"}
+        for i in range(400)
+    ]
+)
+REGEXES = [r"`\w+`", r"\d{4}-\d{2}-\d{2}", r"Rule \d+"]
+
+
+async def ticker(lags: list[float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+
+async def compression(rounds: int) -> None:
+    for _ in range(rounds):
+        await asyncio.sleep(0.01)
+        await offload(count_tokens, PROMPT, weight=len(PROMPT))
+        await offload(extract_statics, PROMPT, REGEXES, weight=len(PROMPT))
+        await offload(decode, RESPONSE, list[Chunk], weight=len(RESPONSE))
+
+
+async def run(concurrency: int, rounds: int) -> tuple[list[float], float]:
+    lags: list[float] = []
+    stop = asyncio.Event()
+    tick = asyncio.create_task(ticker(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*[compression(rounds) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await tick
+    return lags, elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--executor", nargs="+", default=["none", "thread", "process"])
+    args = parser.parse_args()
+
+    count_tokens("warm up")
+    print(f"{'executor':<10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'total s':>10}")
+    for name in args.executor:
+        set_executor(None if name == "none" else name, args.workers)
+        if name == "process":
+            asyncio.run(run(args.workers or 4, 1))
+        lags, elapsed = asyncio.run(run(args.concurrency, args.rounds))
+        lags.sort()
+        print(
+            f"{name:<10}"
+            f"{statistics.median(lags) * 1000:>10.1f}"
+            f"{lags[int(len(lags) * 0.99)] * 1000:>10.1f}"
+            f"{lags[-1] * 1000:>10.1f}"
+            f"{elapsed:>10.2f}"
+        )
+    set_executor(None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Size and encode/decode time of cache values under each serializer.
+
+The payloads are the values the pipeline actually caches: compressed chunk
+lists, static chunks, comparison results, checkpoints and plain strings.
+
+    python benchmarks/serializer.py --repeat 2000
+"""
+
+import argparse
+import timeit
+
+from aiocache.serializers import PickleSerializer
+
+from compress_gpt.checkpoint import AttemptState
+from compress_gpt.prompts.compare_prompts import PromptComparison
+from compress_gpt.prompts.compress_chunks import Chunk
+from compress_gpt.prompts.identify_static import StaticChunk
+from compress_gpt.serializer import TypedSerializer
+
+CHUNKS = [
+    Chunk(m="c", t=f"rule {i}: cal tool->sched mtg, confirm attendees")
+    if i % 4
+    else Chunk(m="r", i=i // 4)
+    for i in range(40)
+]
+PAYLOADS = {
+    "str": "Decompress & follow: be terse, answer in French, cite sources.",
+    "long str": "- Rule: use the `calendar` tool and confirm attendees.\n" * 200,
+    "chunks": CHUNKS,
+    "statics": [StaticChunk(regex=r"`\w+`", reason="tool names")] * 5,
+    "comparison": PromptComparison(
+        discrepancies=["Lost the rule about French"], equivalent=False
+    ),
+    "checkpoint": AttemptState(
+        chunks=CHUNKS, discrepancies=["Lost the rule about French"] * 3, attempt=2
+    ),
+}
+SERIALIZERS = {"pickle": PickleSerializer(), "typed": TypedSerializer()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'payload':<12}{'format':<8}{'bytes':>8}{'dumps us':>10}{'loads us':>10}")
+    for name, value in PAYLOADS.items():
+        for kind, serializer in SERIALIZERS.items():
+            data = serializer.dumps(value)
+            assert serializer.loads(data) == value
+            dumps = min(
+                timeit.repeat(lambda: serializer.dumps(value), number=args.repeat)
+            )
+            loads = min(
+                timeit.repeat(lambda: serializer.loads(data), number=args.repeat)
+            )
+            print(
+                f"{name:<12}{kind:<8}{len(data):>8}"
+                f"{dumps / args.repeat * 1e6:>10.1f}"
+                f"{loads / args.repeat * 1e6:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
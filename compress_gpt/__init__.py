@@ -7,40 +7,63 @@ from pathlib import Path
 import langchain
 import nest_asyncio
 from aiocache import Cache, cached
-from aiocache.serializers import PickleSerializer
-from langchain.cache import RedisCache, SQLiteCache
-from redis import Redis
+from langchain.cache import SQLiteCache
 
-from compress_gpt.utils import has_redis
+from compress_gpt.backend import SharedLLMCache, SharedRedisCache, has_redis
+from compress_gpt.serializer import TypedSerializer
+from compress_gpt.tracing import TracingPlugin
+from compress_gpt.utils import CACHE_NAMESPACE, cache_key
 
 nest_asyncio.apply()
 
 CACHE_DIR = Path(os.getenv("XDG_CACHE_HOME", "~/.cache")).expanduser() / "compress-gpt"
 CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
+
+def _local_llm_cache() -> SQLiteCache:
+    return SQLiteCache(database_path=str(CACHE_DIR / "langchain.db"))
+
+
 if has_redis():
-    langchain.llm_cache = RedisCache(redis_=Redis())
+    langchain.llm_cache = SharedLLMCache(CACHE_NAMESPACE, local=_local_llm_cache)
     cache = partial(
         cached,
         ttl=timedelta(days=7),
-        cache=Cache.REDIS,
-        serializer=PickleSerializer(),
-        noself=True,
+        cache=SharedRedisCache,
+        serializer=TypedSerializer(),
+        key_builder=cache_key,
+        plugins=[TracingPlugin()],
     )
 else:
-    langchain.llm_cache = SQLiteCache(
-        database_path=str(CACHE_DIR / "langchain.db"),
-    )
+    langchain.llm_cache = _local_llm_cache()
     cache = partial(
         cached,
         cache=Cache.MEMORY,
-        serializer=PickleSerializer(),
-        noself=True,
+        serializer=TypedSerializer(),
+        key_builder=cache_key,
+        plugins=[TracingPlugin()],
     )
 
 
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = Cache(
+            cache.keywords["cache"],
+            serializer=cache.keywords["serializer"],
+            namespace=f"{CACHE_NAMESPACE}:store:",
+            plugins=cache.keywords["plugins"],
+        )
+    return _store
+
+
 async def aclear_cache():
-    await Cache(cache.keywords["cache"]).clear()
+    from compress_gpt.caching import clear
+
+    return await clear()
 
 
 def clear_cache():
@@ -0,0 +1,133 @@
+import math
+import re
+from typing import Literal, Optional
+
+from pydantic import BaseModel
+
+from compress_gpt import get_store
+from compress_gpt.minimize import minimize, render
+from compress_gpt.serializer import register
+from compress_gpt.tracing import PRICES, CompressionReport
+from compress_gpt.utils import count_tokens, digest
+
+TDecision = Literal["compress", "defer", "skip"]
+
+# Template variables and fenced code come back verbatim, so they don't shrink.
+PROTECTED = re.compile(r"```.*?```|\{\w+\}|<<v\d+>>", re.DOTALL)
+
+# Until there is history, assume the compressed body is this fraction of the
+# original and that compressing costs this many LLM tokens per prompt token,
+# plus the fixed size of the stage prompts themselves (format, static, chunks,
+# decompress, diff and compare for complex prompts; chunks onwards otherwise).
+PRIOR_RATIO = {True: 0.45, False: 0.6}
+PRIOR_COST = {True: 7.0, False: 5.0}
+FIXED_COST = {True: 2_500, False: 1_600}
+# How many prompt tokens of evidence the priors are worth.
+PRIOR_TOKENS = 2_000
+
+
+@register
+class Admission(BaseModel):
+    decision: TDecision
+    tokens: int
+    # Wrapper and protected tokens, which compression can't remove.
+    overhead: int = 0
+    expected_tokens: int = 0
+    cost: float = 0.0
+    uses: int = 0
+    cached: bool = False
+
+    @property
+    def savings(self) -> int:
+        return self.tokens - self.expected_tokens
+
+
+@register
+class History(BaseModel):
+    tokens: int = 0
+    body_tokens: int = 0
+    spent_tokens: int = 0
+    count: int = 0
+
+
+class AdmissionPolicy(BaseModel):
+    # How many times the compressed prompt is expected to be sent.
+    uses: int = 100
+    # The model the prompt is sent to; defaults to the compression model.
+    model: Optional[str] = None
+    min_savings: int = 1
+
+    def _key(self, tag: str, prompt: str) -> str:
+        return f"admission:{digest(tag)}:{digest(prompt)}"
+
+    def _history_key(self, complex: bool) -> str:
+        return f"admission:history:complex={complex}"
+
+    def weight(self, model: str) -> float:
+        # Compression tokens, in units of tokens of the prompt being sent.
+        spent = PRICES.get(model, (0.0, 0.0))[0]
+        sent = PRICES.get(self.model or model, (0.0, 0.0))[0]
+        return spent / sent if spent and sent else 1.0
+
+    async def history(self, complex: bool) -> History:
+        return await get_store().get(self._history_key(complex)) or History()
+
+    async def estimate(
+        self, prompt: str, model: str, complex: bool, minimize_wrapper: bool = True
+    ) -> Admission:
+        tokens = count_tokens(prompt)
+        protected = sum(count_tokens(m[0]) for m in PROTECTED.finditer(prompt))
+        wrapper = minimize("", "") if minimize_wrapper else render("", "")
+        history = await self.history(complex)
+        ratio = (history.body_tokens + PRIOR_RATIO[complex] * PRIOR_TOKENS) / (
+            history.tokens + PRIOR_TOKENS
+        )
+        rate = (history.spent_tokens + PRIOR_COST[complex] * PRIOR_TOKENS) / (
+            history.tokens + PRIOR_TOKENS
+        )
+        overhead = count_tokens(wrapper) + protected
+        return Admission(
+            decision="compress",
+            tokens=tokens,
+            overhead=overhead,
+            expected_tokens=overhead + math.ceil(ratio * (tokens - protected)),
+            cost=(FIXED_COST[complex] + rate * tokens) * self.weight(model),
+        )
+
+    async def admit(
+        self,
+        tag: str,
+        prompt: str,
+        model: str,
+        complex: bool,
+        minimize_wrapper: bool = True,
+    ) -> Admission:
+        store = get_store()
+        key = self._key(tag, prompt)
+        saved = await store.get(key)
+        if saved is not None and saved.decision != "defer":
+            return saved.copy(update={"cached": True})
+        admission = await self.estimate(prompt, model, complex, minimize_wrapper)
+        admission.uses = saved.uses + 1 if saved is not None else 1
+        if admission.savings < self.min_savings:
+            admission.decision = "skip"
+        elif max(self.uses, admission.uses) * admission.savings < admission.cost:
+            admission.decision = "defer"
+        await store.set(key, admission)
+        return admission
+
+    async def observe(
+        self, admission: Admission, report: CompressionReport, complex: bool
+    ) -> None:
+        # Only fresh, complete compressions teach us anything.
+        if admission.cached or admission.decision != "compress" or report.partial:
+            return
+        spent = report.input_tokens + report.output_tokens
+        if not spent:
+            return
+        history = await self.history(complex)
+        history.tokens += admission.tokens - admission.overhead
+        history.body_tokens += max(report.end_tokens - admission.overhead, 0)
+        history.spent_tokens += max(spent - FIXED_COST[complex], 0)
+        history.count += 1
+        await get_store().set(self._history_key(complex), history)
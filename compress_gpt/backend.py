@@ -0,0 +1,179 @@
+import functools
+import hashlib
+import os
+import time
+from typing import Callable, Optional
+
+import redis
+import redis.asyncio
+from aiocache import RedisCache
+from aiocache.backends.memory import SimpleMemoryBackend
+from langchain.cache import BaseCache as LLMCache
+from langchain.cache import RedisCache as LLMRedisCache
+from langchain.schema import Generation
+from pydantic import BaseModel
+
+from compress_gpt.log import logger
+
+REDIS_ERRORS = (redis.ConnectionError, redis.TimeoutError, OSError)
+
+# Generations are fetched this many indices at a time; chat models return one.
+LOOKUP_BATCH = 4
+
+
+class RedisSettings(BaseModel):
+    url: str = "redis://localhost:6379/0"
+    max_connections: int = 32
+    socket_timeout: float = 1.0
+    connect_timeout: float = 0.5
+    retry_after: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> "RedisSettings":
+        env = {
+            "url": os.getenv("COMPRESS_GPT_REDIS_URL") or os.getenv("REDIS_URL"),
+            "max_connections": os.getenv("COMPRESS_GPT_REDIS_POOL_SIZE"),
+            "socket_timeout": os.getenv("COMPRESS_GPT_REDIS_TIMEOUT"),
+            "connect_timeout": os.getenv("COMPRESS_GPT_REDIS_CONNECT_TIMEOUT"),
+            "retry_after": os.getenv("COMPRESS_GPT_REDIS_RETRY_AFTER"),
+        }
+        return cls(**{k: v for k, v in env.items() if v})
+
+    def pool_kwargs(self) -> dict:
+        return {
+            "max_connections": self.max_connections,
+            "socket_timeout": self.socket_timeout,
+            "socket_connect_timeout": self.connect_timeout,
+        }
+
+
+settings = RedisSettings.from_env()
+
+
+@functools.cache
+def sync_client() -> redis.Redis:
+    pool = redis.ConnectionPool.from_url(settings.url, **settings.pool_kwargs())
+    return redis.Redis(connection_pool=pool)
+
+
+@functools.cache
+def async_client() -> redis.asyncio.Redis:
+    pool = redis.asyncio.ConnectionPool.from_url(settings.url, **settings.pool_kwargs())
+    return redis.asyncio.Redis(connection_pool=pool)
+
+
+def has_redis() -> bool:
+    try:
+        return bool(sync_client().ping())
+    except Exception:
+        return False
+
+
+class Circuit:
+    def __init__(self) -> None:
+        self.open_until = 0.0
+
+    @property
+    def closed(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def trip(self, error: Exception) -> None:
+        if self.closed:
+            logger.warning(
+                "Redis unavailable (%s), using the local cache for %.0fs",
+                error,
+                settings.retry_after,
+            )
+        self.open_until = time.monotonic() + settings.retry_after
+
+    def reset(self) -> None:
+        self.open_until = 0.0
+
+
+circuit = Circuit()
+
+
+def _with_fallback(name: str) -> Callable:
+    async def method(self, *args, **kwargs):
+        if circuit.closed:
+            try:
+                return await getattr(super(SharedRedisCache, self), name)(
+                    *args, **kwargs
+                )
+            except REDIS_ERRORS as e:
+                circuit.trip(e)
+        return await getattr(self.local, name)(*args, **kwargs)
+
+    method.__name__ = name
+    return method
+
+
+class SharedRedisCache(RedisCache):
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.client = async_client()
+        self.local = SimpleMemoryBackend()
+
+    _get = _with_fallback("_get")
+    _gets = _with_fallback("_gets")
+    _multi_get = _with_fallback("_multi_get")
+    _set = _with_fallback("_set")
+    _multi_set = _with_fallback("_multi_set")
+    _add = _with_fallback("_add")
+    _exists = _with_fallback("_exists")
+    _increment = _with_fallback("_increment")
+    _expire = _with_fallback("_expire")
+    _delete = _with_fallback("_delete")
+    _clear = _with_fallback("_clear")
+
+
+class SharedLLMCache(LLMRedisCache):
+    def __init__(self, namespace: str, local: Callable[[], LLMCache]) -> None:
+        super().__init__(redis_=sync_client())
+        self.namespace = namespace
+        self._local = local
+
+    @functools.cached_property
+    def local(self) -> LLMCache:
+        return self._local()
+
+    def _key(self, prompt: str, llm_string: str, idx: int) -> str:
+        # langchain uses hash(), which is salted per process.
+        digest = hashlib.sha256(f"{prompt}\0{llm_string}".encode()).hexdigest()
+        # Under the namespace like every other stage, so the cache tools see it.
+        return f"{self.namespace}:llm:{digest}:{idx}"
+
+    def _lookup(self, prompt: str, llm_string: str) -> Optional[list[Generation]]:
+        generations: list[Generation] = []
+        while True:
+            start = len(generations)
+            keys = [
+                self._key(prompt, llm_string, i)
+                for i in range(start, start + LOOKUP_BATCH)
+            ]
+            for value in self.redis.mget(keys):
+                if value is None:
+                    return generations or None
+                generations.append(Generation(text=value.decode()))
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[list[Generation]]:
+        if circuit.closed:
+            try:
+                return self._lookup(prompt, llm_string)
+            except REDIS_ERRORS as e:
+                circuit.trip(e)
+        return self.local.lookup(prompt, llm_string)
+
+    def update(
+        self, prompt: str, llm_string: str, return_val: list[Generation]
+    ) -> None:
+        if circuit.closed:
+            try:
+                with self.redis.pipeline(transaction=False) as pipe:
+                    for i, generation in enumerate(return_val):
+                        pipe.set(self._key(prompt, llm_string, i), generation.text)
+                    pipe.execute()
+                return
+            except REDIS_ERRORS as e:
+                circuit.trip(e)
+        self.local.update(prompt, llm_string, return_val)
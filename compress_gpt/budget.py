@@ -0,0 +1,73 @@
+import asyncio
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from compress_gpt.utils import count_tokens
+
+T = TypeVar("T")
+
+CANCEL_POLL = 0.05
+
+
+class Budget:
+    def __init__(
+        self, deadline: Optional[float] = None, target_tokens: Optional[int] = None
+    ) -> None:
+        self.deadline = deadline
+        self.target_tokens = target_tokens
+        self.best: Optional[str] = None
+        self.best_tokens: Optional[int] = None
+        self.values: list[str] = []
+        self.finished = False
+        self.reached = asyncio.Event()
+
+    def offer(self, candidate: str) -> None:
+        tokens = count_tokens(candidate)
+        if self.best_tokens is None or tokens < self.best_tokens:
+            self.best, self.best_tokens = candidate, tokens
+        if self.target_tokens is not None and tokens <= self.target_tokens:
+            self.reached.set()
+
+
+_budget: ContextVar[Optional[Budget]] = ContextVar("budget", default=None)
+
+
+def current_budget() -> Optional[Budget]:
+    return _budget.get()
+
+
+def offer(candidate: Callable[[], str]) -> None:
+    # Candidates are only rendered when someone is waiting on a budget.
+    if (budget := _budget.get()) is not None:
+        budget.offer(candidate())
+
+
+async def cancel(tasks: list[asyncio.Future]) -> None:
+    # asyncio.wait_for (used by aiocache) can swallow a cancellation that
+    # races with its inner call finishing, so keep asking until it sticks.
+    while pending := [t for t in tasks if not t.done()]:
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending, timeout=CANCEL_POLL)
+
+
+async def bounded(coro: Awaitable[T], budget: Budget) -> Optional[T]:
+    token = _budget.set(budget)
+    try:
+        task = asyncio.ensure_future(coro)
+    finally:
+        _budget.reset(token)
+    reached = asyncio.ensure_future(budget.reached.wait())
+    try:
+        await asyncio.wait(
+            {task, reached},
+            timeout=budget.deadline,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+    finally:
+        reached.cancel()
+        await cancel([task])
+    if task.cancelled():
+        return None
+    budget.finished = True
+    return task.result()
@@ -0,0 +1,147 @@
+import gzip
+import itertools
+import shutil
+import sqlite3
+import tempfile
+import time
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import Iterator, Union
+
+import langchain
+from aiocache.base import BaseCache
+from langchain.cache import SQLAlchemyCache
+from sqlalchemy.orm import Session
+
+from compress_gpt import cache
+from compress_gpt.caching import SCAN_BATCH, caches, scan
+from compress_gpt.log import logger
+from compress_gpt.utils import CACHE_NAMESPACE, key_stage
+
+# Version 2 stores keys relative to the cache namespace; version 3 stores
+# values with the cache's typed serializer instead of pickle.
+BUNDLE_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE entries (cache TEXT, key TEXT, value BLOB, PRIMARY KEY (cache, key));
+CREATE TABLE llm_cache (prompt TEXT, llm TEXT, idx INTEGER, response TEXT,
+                        PRIMARY KEY (prompt, llm, idx));
+"""
+
+
+def _package_version() -> str:
+    try:
+        return version("compress-gpt")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def _batches(
+    entries: list[tuple[BaseCache, str]]
+) -> Iterator[tuple[BaseCache, list[str]]]:
+    for c, group in itertools.groupby(entries, key=lambda e: e[0]):
+        keys = [key for _, key in group]
+        for i in range(0, len(keys), SCAN_BATCH):
+            yield c, keys[i : i + SCAN_BATCH]
+
+
+def _export_llm_cache(db: sqlite3.Connection) -> int:
+    if not isinstance(langchain.llm_cache, SQLAlchemyCache):
+        logger.warning("Skipping LLM cache export: only SQLite/SQLAlchemy is supported")
+        return 0
+    schema = langchain.llm_cache.cache_schema
+    with Session(langchain.llm_cache.engine) as session:
+        rows = [
+            (row.prompt, row.llm, row.idx, row.response)
+            for row in session.query(schema)
+        ]
+    db.executemany("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def _import_llm_cache(db: sqlite3.Connection) -> int:
+    if not isinstance(langchain.llm_cache, SQLAlchemyCache):
+        logger.warning("Skipping LLM cache import: only SQLite/SQLAlchemy is supported")
+        return 0
+    schema = langchain.llm_cache.cache_schema
+    rows = db.execute("SELECT prompt, llm, idx, response FROM llm_cache").fetchall()
+    with Session(langchain.llm_cache.engine) as session:
+        for prompt, llm, idx, response in rows:
+            session.merge(schema(prompt=prompt, llm=llm, idx=idx, response=response))
+        session.commit()
+    return len(rows)
+
+
+async def export_cache(path: Union[str, Path]) -> dict[str, int]:
+    serializer = cache.keywords["serializer"]
+    counts: dict[str, int] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "bundle.db"
+        db = sqlite3.connect(db_path)
+        db.executescript(SCHEMA)
+        db.executemany(
+            "INSERT INTO meta VALUES (?, ?)",
+            [
+                ("bundle_version", str(BUNDLE_VERSION)),
+                ("compress_gpt_version", _package_version()),
+                ("created", str(int(time.time()))),
+                ("namespace", CACHE_NAMESPACE),
+            ],
+        )
+        # LLM responses are raw text on Redis; _export_llm_cache covers SQLite.
+        entries = [
+            e for e in await scan(f"{CACHE_NAMESPACE}:*") if key_stage(e[1]) != "llm"
+        ]
+        for c, keys in _batches(entries):
+            for key, value in zip(keys, await c.multi_get(keys, namespace="")):
+                if value is None:
+                    continue
+                stage = key_stage(key)
+                relative = key[len(CACHE_NAMESPACE) + 1 :]
+                db.execute(
+                    "INSERT INTO entries VALUES (?, ?, ?)",
+                    (stage, relative, serializer.dumps(value)),
+                )
+                counts[stage] = counts.get(stage, 0) + 1
+        counts["llm_cache"] = _export_llm_cache(db)
+        db.commit()
+        db.close()
+        with open(db_path, "rb") as src, gzip.open(path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+    return counts
+
+
+async def import_cache(path: Union[str, Path]) -> dict[str, int]:
+    targets = caches()
+    ttl = cache.keywords.get("ttl")
+    serializer = cache.keywords["serializer"]
+    counts: dict[str, int] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "bundle.db"
+        with gzip.open(path, "rb") as src, open(db_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        db = sqlite3.connect(db_path)
+        meta = dict(db.execute("SELECT key, value FROM meta").fetchall())
+        bundle_version = int(meta.get("bundle_version", 0))
+        if bundle_version > BUNDLE_VERSION:
+            db.close()
+            raise ValueError(
+                f"Bundle version {bundle_version} is newer than supported ({BUNDLE_VERSION})"
+            )
+        if bundle_version < BUNDLE_VERSION:
+            logger.warning("Skipping cache entries from an old bundle format")
+        rows = db.execute("SELECT cache, key, value FROM entries")
+        for stage, key, value in rows if bundle_version == BUNDLE_VERSION else []:
+            if stage not in targets:
+                logger.warning("Skipping entries for unknown cache: %s", stage)
+                continue
+            if (loaded := serializer.loads(value)) is None:
+                continue
+            await targets[stage].set(
+                f"{CACHE_NAMESPACE}:{key}", loaded, ttl=ttl, namespace=""
+            )
+            counts[stage] = counts.get(stage, 0) + 1
+        counts["llm_cache"] = _import_llm_cache(db)
+        db.close()
+    return counts
@@ -0,0 +1,132 @@
+from fnmatch import fnmatchcase
+from typing import Optional
+
+from aiocache import SimpleMemoryCache
+from aiocache.base import BaseCache
+from pydantic import BaseModel
+
+from compress_gpt import get_store
+from compress_gpt.checkpoint import local_checkpoints
+from compress_gpt.compress import ROLE_LINE, Compressor
+from compress_gpt.tracing import cache_counters
+from compress_gpt.utils import CACHE_NAMESPACE, digest, key_stage
+
+SCAN_BATCH = 500
+
+
+class CacheEntry(BaseModel):
+    key: str
+    stage: str
+    size: int
+
+
+class StageStats(BaseModel):
+    entries: int = 0
+    bytes: int = 0
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+
+def caches() -> dict[str, BaseCache]:
+    result = {"store": get_store()}
+    for name in dir(Compressor):
+        f = getattr(Compressor, name)
+        if isinstance(c := getattr(f, "cache", None), BaseCache):
+            result[name.lstrip("_")] = c
+    return result
+
+
+def _pattern(stage: Optional[str] = None, prompt: Optional[str] = None) -> str:
+    pattern = f"{CACHE_NAMESPACE}:{stage or '*'}:"
+    return pattern + (f"{digest(prompt)}:*" if prompt is not None else "*")
+
+
+async def scan(pattern: str) -> list[tuple[BaseCache, str]]:
+    store = get_store()
+    if not isinstance(store, SimpleMemoryCache):
+        keys = []
+        async for key in store.client.scan_iter(match=pattern, count=SCAN_BATCH):
+            keys.append((store, key.decode() if isinstance(key, bytes) else key))
+        return keys
+    return [
+        (c, key)
+        for c in caches().values()
+        for key in list(c._cache)
+        if fnmatchcase(key, pattern)
+    ]
+
+
+async def _sizes(entries: list[tuple[BaseCache, str]]) -> list[int]:
+    store = get_store()
+    if isinstance(store, SimpleMemoryCache):
+        return [len(c._cache.get(key) or b"") for c, key in entries]
+    sizes = []
+    for i in range(0, len(entries), SCAN_BATCH):
+        async with store.client.pipeline(transaction=False) as pipe:
+            for _, key in entries[i : i + SCAN_BATCH]:
+                pipe.strlen(key)
+            sizes.extend(await pipe.execute())
+    return sizes
+
+
+async def _delete(entries: list[tuple[BaseCache, str]]) -> int:
+    store = get_store()
+    if isinstance(store, SimpleMemoryCache):
+        for c, key in entries:
+            await c.delete(key, namespace="")
+        return len(entries)
+    deleted = 0
+    for i in range(0, len(entries), SCAN_BATCH):
+        batch = [key for _, key in entries[i : i + SCAN_BATCH]]
+        deleted += await store.client.unlink(*batch)
+    return deleted
+
+
+async def list_entries(
+    stage: Optional[str] = None, prompt: Optional[str] = None
+) -> list[CacheEntry]:
+    entries = await scan(_pattern(stage, prompt))
+    sizes = await _sizes(entries)
+    return sorted(
+        (
+            CacheEntry(key=key, stage=key_stage(key), size=size)
+            for (_, key), size in zip(entries, sizes)
+        ),
+        key=lambda e: e.key,
+    )
+
+
+async def invalidate(stage: Optional[str] = None, prompt: Optional[str] = None) -> int:
+    if stage is None and prompt is None:
+        raise ValueError("Pass a stage and/or a prompt, or use clear().")
+    entries = await scan(_pattern(stage, prompt))
+    # Only keys whose first argument is this exact text. Entries derived from
+    # it under other keys (decompress, split segments, the store) remain.
+    if prompt is not None:
+        if (cleaned := ROLE_LINE.sub("", prompt)) != prompt:
+            entries += await scan(_pattern(stage, cleaned))
+    return await _delete(entries)
+
+
+async def stats() -> dict[str, StageStats]:
+    result: dict[str, StageStats] = {}
+    for entry in await list_entries():
+        s = result.setdefault(entry.stage, StageStats())
+        s.entries += 1
+        s.bytes += entry.size
+    for stage, (hits, misses) in cache_counters.items():
+        s = result.setdefault(stage, StageStats())
+        s.hits, s.misses = hits, misses
+    return result
+
+
+async def clear() -> int:
+    deleted = await _delete(await scan(f"{CACHE_NAMESPACE}:*"))
+    if isinstance(get_store(), SimpleMemoryCache):
+        deleted += local_checkpoints().clear()
+    return deleted
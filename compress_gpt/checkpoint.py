@@ -0,0 +1,104 @@
+import sqlite3
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import Any, Optional, Type, TypeVar, Union
+
+from aiocache import SimpleMemoryCache
+from pydantic import BaseModel
+
+from compress_gpt import CACHE_DIR, get_store
+from compress_gpt.prompts.compress_chunks import Chunk
+from compress_gpt.serializer import TypedSerializer, register
+from compress_gpt.utils import digest
+
+S = TypeVar("S", bound=BaseModel)
+
+# Long enough to outlive a preempted node; stale runs then expire on their own.
+CHECKPOINT_TTL = int(timedelta(days=1).total_seconds())
+CHECKPOINT_DB = CACHE_DIR / "checkpoints.db"
+
+
+@register
+class SegmentState(BaseModel):
+    # Chunks refer to statics by index, so a resumed run must reuse these
+    # rather than recompute them.
+    static_chunks: list[str]
+    initial: Optional[list[Chunk]] = None
+
+
+@register
+class AttemptState(BaseModel):
+    chunks: list[Chunk]
+    discrepancies: list[str] = []
+    attempt: int = 0
+
+
+def segment_key(tag: str, prompt: str, format: str) -> str:
+    return f"checkpoint:{digest(tag)}:{digest(prompt)}:{digest(format)}"
+
+
+def attempt_key(tag: str, prompt: str, statics: str, variant: int) -> str:
+    return f"checkpoint:{digest(tag)}:{digest(prompt)}:{digest(statics)}:{variant}"
+
+
+class LocalCheckpoints:
+    # Without Redis the store lives in memory and dies with the process, so
+    # checkpoints go to a SQLite file next to the LLM cache instead.
+    def __init__(self, path: Union[str, Path] = CHECKPOINT_DB) -> None:
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints "
+            "(key TEXT PRIMARY KEY, value BLOB, expires REAL)"
+        )
+        self.serializer = TypedSerializer()
+
+    async def get(self, key: str) -> Any:
+        row = self.db.execute(
+            "SELECT value FROM checkpoints WHERE key = ? AND expires > ?",
+            (key, time.time()),
+        ).fetchone()
+        return self.serializer.loads(row[0]) if row else None
+
+    async def set(self, key: str, value: Any, ttl: int) -> None:
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)",
+                (key, self.serializer.dumps(value), time.time() + ttl),
+            )
+
+    async def delete(self, key: str) -> None:
+        with self.db:
+            self.db.execute("DELETE FROM checkpoints WHERE key = ?", (key,))
+
+    def clear(self) -> int:
+        with self.db:
+            return self.db.execute("DELETE FROM checkpoints").rowcount
+
+
+_local: Optional[LocalCheckpoints] = None
+
+
+def local_checkpoints() -> LocalCheckpoints:
+    global _local
+    if _local is None:
+        _local = LocalCheckpoints()
+    return _local
+
+
+def _backend() -> Any:
+    store = get_store()
+    return local_checkpoints() if isinstance(store, SimpleMemoryCache) else store
+
+
+async def load(key: str, kind: Type[S]) -> Optional[S]:
+    state = await _backend().get(key)
+    return state if isinstance(state, kind) else None
+
+
+async def save(key: str, state: BaseModel) -> None:
+    await _backend().set(key, state, ttl=CHECKPOINT_TTL)
+
+
+async def clear(key: str) -> None:
+    await _backend().delete(key)
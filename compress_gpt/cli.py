@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+from rich.console import Console
+from rich.progress import (
+    BarColumn,
+    MofNCompleteColumn,
+    Progress,
+    TextColumn,
+    TimeElapsedColumn,
+)
+from rich.table import Table
+
+from compress_gpt import aclear_cache
+from compress_gpt.bundle import export_cache, import_cache
+from compress_gpt.caching import invalidate, stats
+from compress_gpt.compress import Compressor
+from compress_gpt.daemon import Daemon
+from compress_gpt.distill import MIN_SUPPORT, LocalCompressor
+from compress_gpt.scheduler import Priority
+
+PROMPT_SUFFIXES = {".txt", ".md", ".prompt"}
+
+console = Console(stderr=True)
+
+
+def read_prompts(path: Path) -> Iterator[tuple[str, str]]:
+    if path.is_dir():
+        for file in sorted(path.rglob("*")):
+            if file.is_file() and file.suffix in PROMPT_SUFFIXES:
+                yield str(file.relative_to(path)), file.read_text()
+        return
+    if path.suffix == ".jsonl":
+        with path.open() as f:
+            for i, line in enumerate(f):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                name = f"{path.name}:{i + 1}"
+                if isinstance(record, str):
+                    yield name, record
+                else:
+                    yield str(record.get("id", name)), record["prompt"]
+        return
+    yield path.name, path.read_text()
+
+
+async def warm(
+    paths: list[Path],
+    model: str,
+    complex: bool,
+    concurrency: int,
+    attempts: int,
+    bundle: Optional[Path],
+) -> int:
+    prompts = [p for path in paths for p in read_prompts(path)]
+    if not prompts:
+        console.print("[red]No prompts found[/red]")
+        return 1
+    compressor = Compressor(
+        model=model, verbose=False, complex=complex, priority=Priority.BACKGROUND
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+    start_tokens = end_tokens = failures = 0
+
+    with Progress(
+        TextColumn("[progress.description]{task.description}"),
+        BarColumn(),
+        MofNCompleteColumn(),
+        TimeElapsedColumn(),
+        console=console,
+    ) as progress:
+        task = progress.add_task("Compressing", total=len(prompts))
+
+        async def run(name: str, prompt: str) -> None:
+            nonlocal start_tokens, end_tokens, failures
+            async with semaphore:
+                result, report = await compressor.acompress_with_report(
+                    prompt, attempts
+                )
+            start_tokens += report.start_tokens
+            end_tokens += report.end_tokens
+            if result == prompt:
+                failures += 1
+                progress.console.print(f"[yellow]Not compressed:[/yellow] {name}")
+            progress.advance(task)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[run(name, prompt) for name, prompt in prompts])
+        elapsed = time.perf_counter() - started
+
+    table = Table(show_header=False)
+    table.add_row("Prompts", str(len(prompts)))
+    table.add_row("Compressed", str(len(prompts) - failures))
+    table.add_row("Elapsed", f"{elapsed:.1f}s")
+    table.add_row("Throughput", f"{len(prompts) / elapsed:.2f} prompts/s")
+    table.add_row("Tokens", f"{start_tokens} -> {end_tokens}")
+    if start_tokens:
+        table.add_row("Savings", f"{(1 - end_tokens / start_tokens) * 100:.1f}%")
+    console.print(table)
+
+    if bundle:
+        await export(bundle)
+    return 0
+
+
+async def export(path: Path) -> int:
+    counts = await export_cache(path)
+    console.print(f"Exported {sum(counts.values())} entries to {path}")
+    if not any(v for k, v in counts.items() if k != "llm_cache"):
+        console.print(
+            "[yellow]The compression cache is empty. With the in-memory backend, "
+            "use `compress-gpt warm --export` to export from the same process.[/yellow]"
+        )
+    return 0
+
+
+async def load(path: Path) -> int:
+    counts = await import_cache(path)
+    console.print(f"Imported {sum(counts.values())} entries from {path}")
+    return 0
+
+
+async def clear() -> int:
+    deleted = await aclear_cache()
+    console.print(f"Deleted {deleted} entries")
+    return 0
+
+
+async def show_stats() -> int:
+    table = Table("Stage", "Entries", "Bytes", "Hits", "Misses", "Hit rate")
+    for stage, s in sorted((await stats()).items()):
+        rate = f"{s.hit_rate * 100:.1f}%" if s.hit_rate is not None else "-"
+        table.add_row(
+            stage, str(s.entries), str(s.bytes), str(s.hits), str(s.misses), rate
+        )
+    Console().print(table)
+    return 0
+
+
+async def drop(stage: Optional[str], prompt: Optional[Path]) -> int:
+    deleted = await invalidate(stage, prompt.read_text() if prompt else None)
+    console.print(f"Deleted {deleted} entries")
+    return 0
+
+
+async def distill(output: Path, min_support: int) -> int:
+    compressor = await LocalCompressor.from_cache(min_support)
+    compressor.save(output)
+    console.print(f"Learned {len(compressor.rules)} rules into {output}")
+    return 0
+
+
+async def serve(socket: Optional[Path]) -> int:
+    daemon = Daemon(socket)
+    console.print(f"Listening on {daemon.path}")
+    await daemon.serve()
+    return 0
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="compress-gpt")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    warm_cmd = commands.add_parser("warm", help="precompress prompts into the cache")
+    warm_cmd.add_argument(
+        "paths",
+        nargs="+",
+        type=Path,
+        help="prompt files, directories of prompt files, or JSONL files",
+    )
+    warm_cmd.add_argument("--model", default="gpt-4")
+    warm_cmd.add_argument("--simple", action="store_true", help="use complex=False")
+    warm_cmd.add_argument("--concurrency", type=int, default=8)
+    warm_cmd.add_argument("--attempts", type=int, default=3)
+    warm_cmd.add_argument("--export", type=Path, help="write a cache bundle when done")
+
+    export_cmd = commands.add_parser("export", help="write the cache to a bundle")
+    export_cmd.add_argument("path", type=Path)
+
+    import_cmd = commands.add_parser("import", help="load a cache bundle")
+    import_cmd.add_argument("path", type=Path)
+
+    commands.add_parser("clear", help="delete every compress-gpt cache entry")
+    commands.add_parser("stats", help="show cache entries and hit rates per stage")
+
+    invalidate_cmd = commands.add_parser(
+        "invalidate", help="delete cache entries for a stage and/or a prompt"
+    )
+    invalidate_cmd.add_argument("--stage", help="e.g. compress, chunks, decompress")
+    invalidate_cmd.add_argument(
+        "--prompt",
+        type=Path,
+        help="file with the prompt; only entries keyed by its text",
+    )
+
+    distill_cmd = commands.add_parser(
+        "distill",
+        help="learn local rewrite rules from pairs recorded with record_pairs=True",
+    )
+    distill_cmd.add_argument("output", type=Path, help="rules file to write (JSON)")
+    distill_cmd.add_argument("--min-support", type=int, default=MIN_SUPPORT)
+
+    serve_cmd = commands.add_parser(
+        "serve", help="compress for every worker on this host over a Unix socket"
+    )
+    serve_cmd.add_argument(
+        "--socket", type=Path, help="defaults to $COMPRESS_GPT_SOCKET"
+    )
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = parser().parse_args(argv)
+    if args.command == "warm":
+        coro = warm(
+            args.paths,
+            args.model,
+            not args.simple,
+            args.concurrency,
+            args.attempts,
+            args.export,
+        )
+    elif args.command == "export":
+        coro = export(args.path)
+    elif args.command == "import":
+        coro = load(args.path)
+    elif args.command == "stats":
+        coro = show_stats()
+    elif args.command == "invalidate":
+        if args.stage is None and args.prompt is None:
+            parser().error("invalidate needs --stage and/or --prompt")
+        coro = drop(args.stage, args.prompt)
+    elif args.command == "distill":
+        coro = distill(args.output, args.min_support)
+    elif args.command == "serve":
+        coro = serve(args.socket)
+    else:
+        coro = clear()
+    return asyncio.run(coro)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,115 +1,425 @@
 import asyncio
 import itertools
 import re
-import traceback
-import warnings
-from typing import Optional
+import time
+from pathlib import Path
+from typing import Callable, Literal, Optional, Type, Union
 
 import openai.error
-import tiktoken
-from langchain.callbacks.base import CallbackManager
+from langchain.callbacks.base import BaseCallbackHandler, CallbackManager
 from langchain.chat_models import ChatOpenAI
 from langchain.schema import OutputParserException
 from langchain.text_splitter import NLTKTextSplitter
 from pydantic import ValidationError
-from rich import print
 
-from compress_gpt import cache
+from compress_gpt import cache, checkpoint
+from compress_gpt.admission import Admission, AdmissionPolicy
+from compress_gpt.budget import Budget, bounded, cancel, current_budget, offer
+from compress_gpt.checkpoint import (
+    AttemptState,
+    SegmentState,
+    attempt_key,
+    segment_key,
+)
+from compress_gpt.daemon import SOCKET, DaemonClient
+from compress_gpt.distill import LocalCompressor, record_pair
+from compress_gpt.executor import offload
+from compress_gpt.fragments import (
+    MIN_BLOCK_TOKENS,
+    FragmentDictionary,
+    attribute,
+    normalize,
+    split_blocks,
+)
+from compress_gpt.localize import align, localize, patch, source_lines, spans
+from compress_gpt.log import enable_logging, logger
+from compress_gpt.minimize import minimize, render
+from compress_gpt.models import CONTEXT_ERROR, ModelRegistry, registry
+from compress_gpt.prompts import Prompt
 from compress_gpt.prompts.compare_prompts import ComparePrompts, PromptComparison
-from compress_gpt.prompts.compress_chunks import Chunk, CompressChunks
+from compress_gpt.prompts.compress_chunks import (
+    STRATEGIES,
+    Chunk,
+    CompressChunks,
+    CompressChunksVariant,
+)
 from compress_gpt.prompts.decompress import Decompress
 from compress_gpt.prompts.diff_prompts import DiffPrompts
 from compress_gpt.prompts.fix import FixPrompt
+from compress_gpt.prompts.fix_chunks import FixChunks
 from compress_gpt.prompts.identify_format import IdentifyFormat
 from compress_gpt.prompts.identify_static import IdentifyStatic, StaticChunk
-from compress_gpt.utils import CompressCallbackHandler, make_fast
+from compress_gpt.prompts.verify_prompts import VerifyPrompts
+from compress_gpt.routing import (
+    DEFAULT_ROUTES,
+    Route,
+    TRouteOverride,
+    TStage,
+    make_routes,
+)
+from compress_gpt.scheduler import Priority, prioritized
+from compress_gpt.session import HTTPLimits, SessionPool
+from compress_gpt.similarity import NearDuplicateIndex
+from compress_gpt.tracing import (
+    CompressionReport,
+    MetricsSink,
+    TracingCallbackHandler,
+    current_report,
+    record,
+    set_attempt,
+    span,
+    traced,
+)
+from compress_gpt.utils import CompressCallbackHandler, count_tokens
+from compress_gpt.volatile import PLACEHOLDER, extract, splice
 
-CONTEXT_WINDOWS = {
-    "gpt-3.5-turbo": 4097,
-    "gpt-4": 8000,
-}
-PROMPT_MAX_SIZE = 0.70
+
+def extract_statics(prompt: str, regexes: list[str]) -> tuple[list[str], list[str]]:
+    static: set[str] = {m[0] for m in PLACEHOLDER.finditer(prompt)}
+    invalid = []
+    for regex in regexes:
+        try:
+            static.update(
+                itertools.chain.from_iterable(
+                    [mg[0]] if len(mg.groups()) == 0 else mg.groups()[1:]
+                    for mg in re.finditer(re.compile(regex, re.MULTILINE), prompt)
+                )
+            )
+        except re.error:
+            invalid.append(regex)
+    return list(s.replace("\n", " ").strip() for s in static - {None}), invalid
+
+
+def split_text(prompt: str, size: int) -> list[str]:
+    splitter = NLTKTextSplitter.from_tiktoken_encoder(
+        encoding_name="cl100k_base", chunk_size=size
+    )
+    return splitter.split_text(prompt)
+
+
+ROLE_LINE = re.compile(r"^(System|User|AI):$", re.MULTILINE)
+
+TCompareMode = Literal["two_stage", "single_pass"]
+TRepairMode = Literal["full", "local"]
+TSplitMode = Literal["independent", "map_reduce"]
 
 
 class Compressor:
+    STAGES: dict[str, tuple[TStage, ...]] = {
+        "_chunks": ("chunks",),
+        "_variant_chunks": ("chunks",),
+        "_static": ("static",),
+        "_decompress": ("decompress",),
+        "_format": ("format",),
+        "_diff_and_compare": ("diff", "compare"),
+        "_verify": ("verify",),
+        "_compress": tuple(DEFAULT_ROUTES),
+        "_fragment": ("static", "chunks", "decompress", "diff", "compare", "verify"),
+    }
+
     def __init__(
-        self, model: str = "gpt-4", verbose: bool = True, complex: bool = True
+        self,
+        model: str = "gpt-4",
+        verbose: bool = True,
+        complex: bool = True,
+        compare: TCompareMode = "two_stage",
+        fast_compare: bool = False,
+        repair: TRepairMode = "full",
+        split: TSplitMode = "independent",
+        routes: Optional[dict[TStage, TRouteOverride]] = None,
+        metrics: Optional[list[MetricsSink]] = None,
+        priority: Priority = Priority.DEFAULT,
+        models: ModelRegistry = registry,
+        fragments: Optional[FragmentDictionary] = None,
+        near_duplicates: Optional[NearDuplicateIndex] = None,
+        volatile: Optional[list[str]] = None,
+        minimize: bool = True,
+        candidates: int = 1,
+        good_enough: float = 0.3,
+        http: Union[HTTPLimits, SessionPool, None] = None,
+        local: Optional[LocalCompressor] = None,
+        verify_local: bool = True,
+        record_pairs: bool = False,
+        admission: Optional[AdmissionPolicy] = None,
+        daemon: Union[str, Path, DaemonClient, None] = SOCKET,
     ) -> None:
-        self.model = ChatOpenAI(
-            temperature=0,
-            verbose=verbose,
-            streaming=True,
-            callback_manager=CallbackManager([CompressCallbackHandler()]),
-            model=model,
-            request_timeout=60 * 5,
-        )
-        self.fast_model = make_fast(self.model)
-        self.encoding = tiktoken.encoding_for_model(model)
+        self.verbose = verbose
+        handlers: list[BaseCallbackHandler] = [TracingCallbackHandler()]
+        if verbose:
+            enable_logging()
+            handlers.insert(0, CompressCallbackHandler())
+        self.callback_manager = CallbackManager(handlers)
+        self.model = self._make_model(model, 60 * 5)
         self.complex = complex
+        self.compare = compare
+        self.repair = repair
+        self.split = split
+        if fast_compare:
+            routes = {"verify": {"fast": True}, **(routes or {})}
+        self.routes = make_routes(routes)
+        self._models: dict[tuple, ChatOpenAI] = {}
+        self.metrics = metrics or []
+        self.priority = priority
+        self.models = models
+        self.fragments = fragments
+        self.near_duplicates = near_duplicates
+        self.volatile = volatile
+        self.minimize = minimize
+        if candidates > len(STRATEGIES):
+            logger.warning("Using %d speculative candidates", len(STRATEGIES))
+        self.candidates = max(1, min(candidates, len(STRATEGIES)))
+        self.good_enough = good_enough
+        self.local = local
+        self.verify_local = verify_local
+        self.record_pairs = record_pairs
+        self.admission = admission
+        self.sessions = (
+            http if isinstance(http, SessionPool) else SessionPool(http or HTTPLimits())
+        )
+        if daemon is not None and not isinstance(daemon, DaemonClient):
+            daemon = DaemonClient(daemon)
+        self.daemon = daemon
+        # The daemon can't see objects that live in this process.
+        if (fragments, near_duplicates, local) != (None, None, None) or (
+            models is not registry
+        ):
+            self.daemon = None
+
+    async def __aenter__(self) -> "Compressor":
+        await self.sessions.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.sessions.__aexit__(*exc)
+
+    def _make_model(
+        self, model: str, timeout: int, max_tokens: Optional[int] = None
+    ) -> ChatOpenAI:
+        return ChatOpenAI(
+            temperature=0,
+            verbose=self.verbose,
+            streaming=self.verbose,
+            callback_manager=self.callback_manager,
+            model_name=model,
+            request_timeout=timeout,
+            max_tokens=max_tokens,
+        )
+
+    def set_route(self, stage: TStage, **overrides) -> None:
+        current = self.routes.get(stage, Route()).dict()
+        self.routes = make_routes({**self.routes, stage: {**current, **overrides}})
+
+    def llm(self, stage: TStage) -> ChatOpenAI:
+        route = self.routes[stage]
+        key = (route.model_name(self.model.model_name), route.timeout, route.max_tokens)
+        if key not in self._models:
+            self._models[key] = self._make_model(*key)
+        return self._models[key]
+
+    def cache_tag(self, name: str) -> str:
+        stages = self.STAGES.get(name, ())
+        tag = ",".join(
+            f"{stage}={self.routes[stage].key(self.model.model_name)}"
+            for stage in stages
+        )
+        if name in ("_static", "_format", "_compress", "_fragment"):
+            tag += f",complex={self.complex}"
+        if name in ("_compress", "_fragment"):
+            tag += f",compare={self.compare}"
+        if name == "_compress":
+            tag += f",split={self.split},fragments={self.fragments is not None}"
+            tag += f",minimize={self.minimize},candidates={self.candidates}"
+            if self.local is not None:
+                tag += f",local={self.local.version},verify_local={self.verify_local}"
+        return f"[{tag}]"
 
+    async def _run(self, stage: TStage, klass: Type[Prompt], **kwargs):
+        model = self.llm(stage)
+        if model.model_name != self.model.model_name:
+            request = await self._count(
+                klass.get_prompt().format_prompt(**kwargs).to_string()
+            )
+            tokens = request + (getattr(model, "max_tokens", None) or request // 2)
+            if not await self.models.fits(model.model_name, tokens):
+                model = self.model
+        async with span(stage, model=model.model_name):
+            try:
+                return await klass.run(
+                    model=model, fix_model=self.llm("fix_json"), **kwargs
+                )
+            except openai.error.InvalidRequestError as e:
+                await self.models.learn(model.model_name, e)
+                raise
+
+    def _stages(self) -> list[TStage]:
+        stages: list[TStage] = ["format", "static", "chunks", "decompress", "fix"]
+        stages += ["verify"] if self.compare == "single_pass" else ["diff", "compare"]
+        if self.repair == "local":
+            stages.append("repair")
+        return stages
+
+    async def _segment_size(self) -> int:
+        return await self.models.segment_size(self.model.model_name, self._stages())
+
+    @traced("_chunks")
     @cache()
     async def _chunks(self, prompt: str, statics: str) -> list[Chunk]:
         try:
-            return await CompressChunks.run(
-                prompt=prompt, statics=statics, model=self.model
+            return await self._run(
+                "chunks", CompressChunks, prompt=prompt, statics=statics
+            )
+        except (OutputParserException, ValidationError):
+            logger.exception("Failed to parse compressed chunks")
+            return []
+
+    @traced("_chunks")
+    @cache()
+    async def _variant_chunks(
+        self, prompt: str, statics: str, strategy: str
+    ) -> list[Chunk]:
+        try:
+            return await self._run(
+                "chunks",
+                CompressChunksVariant,
+                prompt=prompt,
+                statics=statics,
+                strategy=strategy,
             )
         except (OutputParserException, ValidationError):
-            traceback.print_exc()
+            logger.exception("Failed to parse compressed chunks")
             return []
 
+    @traced("_static")
     @cache()
     async def _static(self, prompt: str) -> list[StaticChunk]:
         if not self.complex:
             return []
         try:
-            return await IdentifyStatic.run(prompt=prompt, model=self.model)
+            return await self._run("static", IdentifyStatic, prompt=prompt)
         except (OutputParserException, ValidationError):
-            traceback.print_exc()
+            logger.exception("Failed to parse static chunks")
             return []
 
+    @traced("_decompress")
     @cache()
     async def _decompress(self, prompt: str, statics: str) -> str:
-        return await Decompress.run(
-            compressed=prompt, statics=statics, model=self.model
+        return await self._run(
+            "decompress", Decompress, compressed=prompt, statics=statics
         )
 
+    @traced("_format")
     @cache()
     async def _format(self, prompt: str) -> str:
         if not self.complex:
             return ""
-        return await IdentifyFormat.run(input=prompt, model=self.model)
+        return await self._run("format", IdentifyFormat, input=prompt)
 
-    @cache()
+    @traced("_compare")
     async def _compare(
         self, original: str, format: str, restored: str
     ) -> PromptComparison:
-        analysis = await DiffPrompts.run(
-            original=original,
-            restored=restored,
-            model=self.model,
+        if self.compare == "single_pass":
+            return await self._verify(original, format, restored)
+        return await self._diff_and_compare(original, format, restored)
+
+    @cache()
+    async def _diff_and_compare(
+        self, original: str, format: str, restored: str
+    ) -> PromptComparison:
+        analysis = await self._run(
+            "diff", DiffPrompts, original=original, restored=restored
         )
-        return await ComparePrompts.run(
+        return await self._run(
+            "compare",
+            ComparePrompts,
             restored=restored,
             formatting=format or "n/a",
             analysis=analysis,
-            model=self.model,
         )
 
+    @cache()
+    async def _verify(
+        self, original: str, format: str, restored: str
+    ) -> PromptComparison:
+        return await self._run(
+            "verify",
+            VerifyPrompts,
+            original=original,
+            restored=restored,
+            formatting=format or "n/a",
+        )
+
+    @traced("_fix")
     async def _fix(
         self, original: str, statics: str, restored: str, discrepancies: list[str]
     ) -> list[Chunk]:
         try:
-            return await FixPrompt.run(
+            return await self._run(
+                "fix",
+                FixPrompt,
                 prompt=original,
                 statics=statics,
                 restored=restored,
                 discrepancies="- " + "\n- ".join(discrepancies),
-                model=self.model,
             )
         except (OutputParserException, ValidationError):
-            traceback.print_exc()
+            logger.exception("Failed to parse fixed chunks")
             return []
 
+    @traced("_repair")
+    async def _repair(
+        self,
+        original: str,
+        static_chunks: list[str],
+        statics: str,
+        chunks: list[Chunk],
+        discrepancies: list[str],
+    ) -> Optional[list[Chunk]]:
+        lines = source_lines(original)
+        owner = align(lines, self._chunk_texts(static_chunks, chunks))
+        targets = localize(discrepancies, lines, owner)
+        if not targets:
+            return None
+        owned = spans(owner, len(chunks))
+        excerpt = sorted({i for j in targets for i in range(*owned[j])})
+        logger.info("Repairing %d/%d chunks...", len(targets), len(chunks))
+        try:
+            patches = await self._run(
+                "repair",
+                FixChunks,
+                statics=statics,
+                excerpt="\n".join(lines[i] for i in excerpt),
+                chunks="\n".join(
+                    f"{j}: {chunks[j].json(by_alias=True, exclude_none=True)}"
+                    for j in targets
+                ),
+                discrepancies="- " + "\n- ".join(discrepancies),
+            )
+        except (OutputParserException, ValidationError):
+            logger.exception("Failed to parse repaired chunks")
+            return None
+        replacements = {p.index: p.chunks for p in patches if p.index in targets}
+        if not replacements:
+            return None
+        return list(
+            itertools.chain.from_iterable(
+                replacements.get(j, [chunk]) for j, chunk in enumerate(chunks)
+            )
+        )
+
+    def _chunk_texts(self, static_chunks: list[str], chunks: list[Chunk]) -> list[str]:
+        texts = []
+        for chunk in chunks:
+            if chunk.mode == "r" and chunk.target is not None:
+                texts.append(
+                    static_chunks[chunk.target]
+                    if 0 <= chunk.target < len(static_chunks)
+                    else ""
+                )
+            else:
+                texts.append(chunk.text or "")
+        return texts
+
     def _reconstruct(
         self,
         static_chunks: list[str],
@@ -123,129 +433,586 @@ class Compressor:
                 try:
                     components.append(static_chunks[chunk.target])
                 except IndexError:
-                    print(
-                        f"[bold yellow]Invalid static chunk index: {chunk.target}[/bold yellow]"
-                    )
+                    logger.warning("Invalid static chunk index: %s", chunk.target)
             elif chunk.text:
                 components.append(chunk.text)
         if not final:
             return "\n".join(components)
-        prompt = (
-            "Below are instructions that you compressed. Decompress & follow them. Don't print the decompressed instructions. Do not ask me for further input before that."
-            + "\n```start,name=INSTRUCTIONS\n"
-            + "\n".join(components)
-            + "\n```end,name=INSTRUCTIONS"
-        )
-        if format:
-            prompt += (
-                "\n\nYou MUST respond to me using the below format. You are not permitted to deviate from it.\n"
-                + "\n```start,name=FORMAT\n"
-                + format
-                + "\n```end,name=FORMAT\n"
-                + "Begin! Remember to use the above format."
-            )
-        return prompt
+        return render("\n".join(components), format)
 
-    def _extract_statics(self, prompt: str, chunks: list[StaticChunk]) -> list[str]:
-        static: set[str] = set()
-        for chunk in chunks:
-            try:
-                static.update(
-                    itertools.chain.from_iterable(
-                        [mg[0]] if len(mg.groups()) == 0 else mg.groups()[1:]
-                        for mg in re.finditer(
-                            re.compile(chunk.regex, re.MULTILINE), prompt
-                        )
-                    )
-                )
-            except re.error:
-                print(f"[bold red]Invalid regex: {chunk.regex}[/bold red]")
-        return list(s.replace("\n", " ").strip() for s in static - {None})
+    async def _wrap(
+        self, static_chunks: list[str], format: str, chunks: list[Chunk]
+    ) -> str:
+        if not self.minimize:
+            return self._reconstruct(static_chunks, format, chunks, final=True)
+        instructions = self._reconstruct(static_chunks, format, chunks)
+        return await offload(
+            minimize, instructions, format, weight=len(instructions) * 8
+        )
 
-    async def _compress_segment(self, prompt: str, format: str, attempts: int) -> str:
-        start_tokens = len(self.encoding.encode(prompt))
-        print(f"\n[bold yellow]Compressing prompt ({start_tokens} tks)[/bold yellow]")
+    async def _extract_statics(
+        self, prompt: str, chunks: list[StaticChunk]
+    ) -> list[str]:
+        static, invalid = await offload(
+            extract_statics,
+            prompt,
+            [chunk.regex for chunk in chunks],
+            weight=len(prompt) * max(len(chunks), 1),
+        )
+        for regex in invalid:
+            logger.warning("Invalid regex: %s", regex)
+        return static
 
-        static_chunks = self._extract_statics(prompt, await self._static(prompt))
-        statics = "\n".join(f"- {i}: {chunk}" for i, chunk in enumerate(static_chunks))
-        print("\n[bold yellow]Static chunks:[/bold yellow]\n", statics)
-        chunks = await self._chunks(prompt, statics)
+    async def _count(self, text: str) -> int:
+        return await offload(count_tokens, text, weight=len(text))
 
-        discrepancies = []
-        for _ in range(attempts):
-            print(f"\n[bold yellow]Attempt #{_ + 1}[/bold yellow]\n")
-            compressed = self._reconstruct(static_chunks, format, chunks)
+    async def _compress_chunks(
+        self,
+        prompt: str,
+        format: str,
+        attempts: int,
+        static_chunks: list[str],
+        statics: str,
+        chunks: Optional[list[Chunk]] = None,
+        variant: int = 0,
+    ) -> Optional[list[Chunk]]:
+        key = attempt_key(self.cache_tag("_fragment"), prompt, statics, variant)
+        if (state := await checkpoint.load(key, AttemptState)) is not None:
+            logger.info("Resuming from attempt #%d", state.attempt + 1)
+        elif chunks is not None:
+            state = AttemptState(chunks=chunks)
+        elif variant:
+            strategy = STRATEGIES[variant]
+            state = AttemptState(
+                chunks=await self._variant_chunks(prompt, statics, strategy)
+            )
+        else:
+            state = AttemptState(chunks=await self._chunks(prompt, statics))
+
+        while state.attempt < attempts:
+            set_attempt(state.attempt + 1)
+            logger.info("Attempt #%d", state.attempt + 1)
+            compressed = self._reconstruct(static_chunks, format, state.chunks)
             restored = await self._decompress(compressed, statics)
             result = await self._compare(prompt, format, restored)
             if result.equivalent:
-                final = self._reconstruct(static_chunks, format, chunks, final=True)
-                end_tokens = len(self.encoding.encode(final))
-                percent = (1 - (end_tokens / start_tokens)) * 100
-                print(
-                    f"\n[bold green]Compressed prompt ({start_tokens} tks -> {end_tokens} tks, {percent:0.2f}% savings)[/bold green]\n"
+                if state.attempt:
+                    await checkpoint.clear(key)
+                if self.record_pairs:
+                    await record_pair(prompt, compressed)
+                return state.chunks
+            logger.info("Fixing %d issues...", len(result.discrepancies))
+            state.discrepancies.extend(result.discrepancies)
+            repaired = None
+            if self.repair == "local":
+                repaired = await self._repair(
+                    prompt, static_chunks, statics, state.chunks, result.discrepancies
                 )
-                if end_tokens < start_tokens:
-                    return final
-                else:
-                    warnings.warn(
-                        "Compressed prompt contains more tokens than original. Try using CompressSimplePrompt."
-                    )
-                    return prompt
-            else:
-                print(
-                    f"\n[bold red]Fixing {len(result.discrepancies)} issues...[/bold red]\n"
+            state.chunks = repaired or await self._fix(
+                prompt, statics, restored, state.discrepancies
+            )
+            state.attempt += 1
+            await checkpoint.save(key, state)
+        await checkpoint.clear(key)
+        return None
+
+    async def _speculate(
+        self,
+        prompt: str,
+        format: str,
+        attempts: int,
+        static_chunks: list[str],
+        statics: str,
+        chunks: Optional[list[Chunk]] = None,
+        render: Optional[Callable[[list[Chunk]], str]] = None,
+    ) -> Optional[list[Chunk]]:
+        if chunks is not None or self.candidates == 1:
+            return await self._compress_chunks(
+                prompt, format, attempts, static_chunks, statics, chunks
+            )
+        tasks = [
+            asyncio.ensure_future(
+                self._compress_chunks(
+                    prompt, format, attempts, static_chunks, statics, variant=i
+                )
+            )
+            for i in range(self.candidates)
+        ]
+        target = await self._count(prompt) * self.good_enough
+        best: Optional[list[Chunk]] = None
+        best_tokens = 0
+        try:
+            for future in asyncio.as_completed(tasks):
+                if (result := await future) is None:
+                    continue
+                tokens = await self._count(
+                    self._reconstruct(static_chunks, format, result)
                 )
-                discrepancies.extend(result.discrepancies)
-                chunks = await self._fix(prompt, statics, restored, discrepancies)
+                logger.info("Verified candidate with %d tokens", tokens)
+                if best is None or tokens < best_tokens:
+                    best, best_tokens = result, tokens
+                    if render is not None:
+                        offer(lambda: render(result))
+                if tokens <= target:
+                    logger.info("Good enough, cancelling the other candidates")
+                    break
+        finally:
+            await cancel(tasks)
+        return best
+
+    async def _finalize(self, prompt: str, final: str) -> str:
+        start_tokens = await self._count(prompt)
+        end_tokens = await self._count(final)
+        percent = (1 - (end_tokens / start_tokens)) * 100
+        logger.info(
+            "Compressed prompt (%d tks -> %d tks, %0.2f%% savings)",
+            start_tokens,
+            end_tokens,
+            percent,
+        )
+        if end_tokens < start_tokens:
+            return final
+        logger.warning(
+            "Compressed prompt contains more tokens than original. Try using CompressSimplePrompt."
+        )
         return prompt
 
-    async def _split_and_compress(
-        self, prompt: str, format: str, attempts: int, window_size: Optional[int] = None
+    async def _patch_near(
+        self, prompt: str, old_prompt: str, old_statics: list[str], old: list[Chunk]
+    ) -> tuple[list[str], list[Chunk]]:
+        text = normalize(prompt)
+        static_chunks = [s for s in old_statics if normalize(s) in text]
+        remap = {old_statics.index(s): i for i, s in enumerate(static_chunks)}
+        invalid = {
+            j for j, c in enumerate(old) if c.mode == "r" and c.target not in remap
+        }
+        statics = "\n".join(f"- {i}: {chunk}" for i, chunk in enumerate(static_chunks))
+
+        old_lines = source_lines(old_prompt)
+        owner = align(old_lines, self._chunk_texts(old_statics, old))
+        chunks: list[Chunk] = []
+        for item in patch(old_lines, source_lines(prompt), owner, len(old), invalid):
+            if isinstance(item, int):
+                chunk = old[item]
+                if chunk.mode == "r":
+                    chunk = Chunk(m="r", i=remap[chunk.target])
+                chunks.append(chunk)
+            elif count_tokens(item) <= MIN_BLOCK_TOKENS:
+                chunks.append(Chunk(m="c", t=item))
+            else:
+                chunks.extend(await self._chunks(item, statics))
+        return static_chunks, chunks
+
+    async def _compress_local(self, prompt: str, format: str) -> Optional[str]:
+        # Inline: the rewrite takes milliseconds, and offloading it to a process
+        # pool would pickle the whole automaton for every segment.
+        text = self.local.rewrite(prompt)
+        if text == prompt:
+            return None
+        if self.verify_local:
+            restored = await self._decompress(text, "")
+            if not (await self._compare(prompt, format, restored)).equivalent:
+                logger.info("Local compression failed verification")
+                return None
+        final = await self._wrap([], format, [Chunk(m="c", t=text)])
+        if await self._count(final) >= await self._count(prompt):
+            return None
+        logger.info("Compressed locally")
+        return await self._finalize(prompt, final)
+
+    async def _segment_statics(self, tag: str, prompt: str) -> SegmentState:
+        near = None
+        if self.near_duplicates is not None:
+            near = await self.near_duplicates.query(tag, prompt)
+        if near is None:
+            chunks = await self._static(prompt)
+            return SegmentState(
+                static_chunks=await self._extract_statics(prompt, chunks)
+            )
+        logger.info("Patching a near-duplicate compression (%.2f similar)", near[0])
+        static_chunks, initial = await self._patch_near(prompt, *near[1])
+        return SegmentState(static_chunks=static_chunks, initial=initial)
+
+    async def _compress_segment(
+        self,
+        prompt: str,
+        format: str,
+        attempts: int,
+        surround: Optional[Callable[[str], str]] = None,
     ) -> str:
-        splitter = NLTKTextSplitter.from_tiktoken_encoder(
-            chunk_size=int(
-                (window_size or CONTEXT_WINDOWS[self.model.model_name])
-                * PROMPT_MAX_SIZE
+        logger.info("Compressing prompt (%d tks)", await self._count(prompt))
+        if self.local is not None:
+            if (local := await self._compress_local(prompt, format)) is not None:
+                return local
+
+        tag = self.cache_tag("_fragment")
+        key = segment_key(tag, prompt, format)
+        if (state := await checkpoint.load(key, SegmentState)) is not None:
+            logger.info(
+                "Resuming with %d checkpointed statics", len(state.static_chunks)
             )
+        else:
+            state = await self._segment_statics(tag, prompt)
+            await checkpoint.save(key, state)
+        static_chunks, initial = state.static_chunks, state.initial
+        statics = "\n".join(f"- {i}: {chunk}" for i, chunk in enumerate(static_chunks))
+        logger.debug("Static chunks:\n%s", statics)
+
+        def candidate(chunks: list[Chunk]) -> str:
+            # Offered to the budget as the whole prompt, not just this segment.
+            text = self._reconstruct(static_chunks, format, chunks, final=True)
+            return text if surround is None else surround(text)
+
+        chunks = await self._speculate(
+            prompt, format, attempts, static_chunks, statics, initial, candidate
         )
-        prompts = [
-            await self._compress_segment(p, format, attempts)
-            for p in splitter.split_text(prompt)
-        ]
+        await checkpoint.clear(key)
+        if chunks is None:
+            return prompt
+        if self.near_duplicates is not None:
+            await self.near_duplicates.add(tag, prompt, (prompt, static_chunks, chunks))
+        return await self._finalize(
+            prompt, await self._wrap(static_chunks, format, chunks)
+        )
+
+    async def _split(self, prompt: str, size: int) -> list[str]:
+        return await offload(split_text, prompt, size, weight=len(prompt))
+
+    async def _split_and_compress(
+        self, prompt: str, format: str, attempts: int, size: int
+    ) -> str:
+        segments = await self._split(prompt, size)
+        prompts: list[str] = []
+        for i, segment in enumerate(segments):
+            prompts.append(
+                await self._compress_segment(
+                    segment,
+                    format,
+                    attempts,
+                    lambda text: "\n".join(prompts + [text] + segments[i + 1 :]),
+                )
+            )
+            offer(lambda: "\n".join(prompts + segments[i + 1 :]))
         return "\n".join(prompts)
 
+    async def _map_reduce(
+        self, prompt: str, format: str, attempts: int, segments: list[str], size: int
+    ) -> str:
+        tag = self.cache_tag("_fragment")
+        known: list[Optional[list[Chunk]]] = [None] * len(segments)
+        groups = [[i] for i in range(len(segments))]
+        if self.fragments is not None:
+            known = await self.fragments.get_many(tag, segments)
+            groups = await self._groups(segments, known, size)
+            logger.info(
+                "Reusing %d of %d blocks",
+                sum(k is not None for k in known),
+                len(segments),
+            )
+        texts = ["\n\n".join(segments[i] for i in group) for group in groups]
+        pending = [u for u, group in enumerate(groups) if known[group[0]] is None]
+        logger.info("Compressing %d segments", len(pending))
+
+        novel = [texts[u] for u in pending]
+        found = await asyncio.gather(*[self._static(s) for s in novel])
+        extracted = await asyncio.gather(
+            *[
+                self._extract_statics(segment, chunks)
+                for segment, chunks in zip(novel, found)
+            ]
+        )
+        static_chunks = list(dict.fromkeys(itertools.chain.from_iterable(extracted)))
+        statics = "\n".join(f"- {i}: {chunk}" for i, chunk in enumerate(static_chunks))
+        logger.debug("Static chunks:\n%s", statics)
+
+        results = [known[group[0]] for group in groups]
+
+        def merged(pending: Optional[tuple[int, list[Chunk]]] = None) -> list[Chunk]:
+            current = list(results)
+            if pending is not None:
+                current[pending[0]] = pending[1]
+            return list(
+                itertools.chain.from_iterable(
+                    result if result is not None else [Chunk(m="c", t=text)]
+                    for text, result in zip(texts, current)
+                )
+            )
+
+        async def verify(u: int) -> None:
+            results[u] = await self._speculate(
+                texts[u],
+                format,
+                attempts,
+                static_chunks,
+                statics,
+                render=lambda chunks: self._reconstruct(
+                    static_chunks, format, merged((u, chunks)), True
+                ),
+            )
+            offer(lambda: self._reconstruct(static_chunks, format, merged(), True))
+
+        await asyncio.gather(*[verify(u) for u in pending])
+        for u in pending:
+            if (result := results[u]) is None:
+                logger.warning("Keeping segment uncompressed")
+            elif self.fragments is not None:
+                chunk_texts = [t for t in self._chunk_texts(static_chunks, result) if t]
+                blocks = [segments[i] for i in groups[u]]
+                for block, block_texts in zip(blocks, attribute(blocks, chunk_texts)):
+                    if block_texts is not None:
+                        resolved = [Chunk(m="c", t=text) for text in block_texts]
+                        await self.fragments.put(tag, block, resolved)
+        return await self._finalize(
+            prompt, await self._wrap(static_chunks, format, merged())
+        )
+
+    async def _groups(
+        self, blocks: list[str], known: list[Optional[list[Chunk]]], size: int
+    ) -> list[list[int]]:
+        # Reused blocks stand alone; runs of new neighbouring blocks share one
+        # map step while they fit in a segment.
+        groups: list[list[int]] = []
+        tokens = 0
+        for i, block in enumerate(blocks):
+            count = await self._count(block)
+            if (
+                known[i] is None
+                and groups
+                and known[groups[-1][-1]] is None
+                and tokens + count <= size
+            ):
+                groups[-1].append(i)
+                tokens += count
+            else:
+                groups.append([i])
+                tokens = count
+        return groups
+
+    async def _blocks(self, prompt: str, size: int) -> list[str]:
+        blocks = await offload(split_blocks, prompt, weight=len(prompt))
+        segments = []
+        for block in blocks:
+            if await self._count(block) > size:
+                segments.extend(await self._split(block, size))
+            else:
+                segments.append(block)
+        return segments
+
+    async def _format_prompt(self, prompt: str, tokens: int) -> str:
+        size = await self.models.segment_size(self.model.model_name, ["format"])
+        for _ in range(2):
+            try:
+                if tokens <= size:
+                    return await self._format(prompt)
+                formats = await asyncio.gather(
+                    *[self._format(p) for p in await self._split(prompt, size)]
+                )
+                return "\n".join(f for f in formats if f.strip())
+            except openai.error.InvalidRequestError as e:
+                if not CONTEXT_ERROR.search(str(e)):
+                    raise
+                size = int(min(tokens, size) * 0.75)
+        raise RuntimeError(
+            "There is not enough context window left to safely compress the prompt."
+        )
+
+    async def _split_segments(
+        self, prompt: str, format: str, attempts: int, size: int
+    ) -> str:
+        if self.fragments is not None:
+            return await self._map_reduce(
+                prompt, format, attempts, await self._blocks(prompt, size), size
+            )
+        if self.split == "map_reduce":
+            return await self._map_reduce(
+                prompt, format, attempts, await self._split(prompt, size), size
+            )
+        return await self._split_and_compress(prompt, format, attempts, size)
+
+    @traced("_compress")
     @cache()
     async def _compress(self, prompt: str, attempts: int) -> str:
-        prompt = re.sub(r"^(System|User|AI):$", "", prompt, flags=re.MULTILINE)
-        try:
-            format = await self._format(prompt)
-        except openai.error.InvalidRequestError:
-            raise RuntimeError(
-                "There is not enough context window left to safely compress the prompt."
-            )
+        prompt = ROLE_LINE.sub("", prompt)
+        tokens = await self._count(prompt)
+        format = await self._format_prompt(prompt, tokens)
+        size = await self._segment_size()
 
         try:
-            if self.model.model_name in CONTEXT_WINDOWS and len(
-                self.encoding.encode(prompt)
-            ) > (CONTEXT_WINDOWS[self.model.model_name] * PROMPT_MAX_SIZE):
-                return await self._split_and_compress(prompt, format, attempts)
+            if tokens > size or self.fragments is not None:
+                return await self._split_segments(prompt, format, attempts, size)
             else:
                 return await self._compress_segment(prompt, format, attempts)
         except openai.error.InvalidRequestError as e:
-            if not (
-                res := re.search(r"maximum context length is (\d+) tokens", str(e))
-            ):
+            if not CONTEXT_ERROR.search(str(e)):
                 raise
-            max_tokens = int(res.group(1))
-            return await self._split_and_compress(prompt, format, attempts, max_tokens)
+            # The failing stage has already taught the registry the real window.
+            size = min(await self._segment_size(), int(min(tokens, size) * 0.75))
+            return await self._split_segments(prompt, format, attempts, size)
 
-    async def acompress(self, prompt: str, attempts: int = 3) -> str:
-        try:
+    async def acompress(
+        self,
+        prompt: str,
+        attempts: int = 3,
+        deadline: Optional[float] = None,
+        target_tokens: Optional[int] = None,
+    ) -> str:
+        result, _ = await self.acompress_with_report(
+            prompt, attempts, deadline, target_tokens
+        )
+        return result
+
+    async def _compress_volatile(self, prompt: str, attempts: int) -> str:
+        stable, values = extract(prompt, self.volatile or [])
+        if not values:
             return await self._compress(prompt, attempts=attempts)
-        except Exception as e:
-            print(f"[bold red]Error: {e}[/bold red]")
-            traceback.print_exc()
+        logger.info("Compressing with %d volatile regions", len(values))
+        if (budget := current_budget()) is not None:
+            budget.values = values
+        compressed = await self._compress(stable, attempts=attempts)
+        if (spliced := splice(compressed, values)) is not None:
+            return spliced
+        logger.warning("Compressed prompt lost volatile placeholders")
+        return await self._compress(prompt, attempts=attempts)
+
+    async def _compress_any(self, prompt: str, attempts: int) -> str:
+        if self.volatile:
+            return await self._compress_volatile(prompt, attempts)
+        return await self._compress(prompt, attempts=attempts)
+
+    async def _compress_bounded(
+        self, prompt: str, attempts: int, budget: Budget
+    ) -> str:
+        result = await bounded(self._compress_any(prompt, attempts), budget)
+        if result is not None:
+            return result
+        best = budget.best
+        if best is not None and budget.values:
+            best = splice(best, budget.values)
+        if best is None or await self._count(best) >= await self._count(prompt):
+            logger.warning("Stopped before any compression was verified")
+            return prompt
+        logger.info("Stopped early, using the best compression so far")
+        return best
+
+    def daemon_config(self) -> dict:
+        return {
+            "model": self.model.model_name,
+            "complex": self.complex,
+            "compare": self.compare,
+            "repair": self.repair,
+            "split": self.split,
+            "routes": {stage: route.dict() for stage, route in self.routes.items()},
+            "priority": int(self.priority),
+            "volatile": self.volatile,
+            "minimize": self.minimize,
+            "candidates": self.candidates,
+            "good_enough": self.good_enough,
+            "record_pairs": self.record_pairs,
+        }
+
+    async def _acompress_remote(
+        self, prompt: str, attempts: int, budget: Optional[Budget] = None
+    ) -> Optional[str]:
+        reply = await self.daemon.compress(
+            {
+                "config": self.daemon_config(),
+                "prompt": prompt,
+                "attempts": attempts,
+                "deadline": budget.deadline if budget is not None else None,
+                "target_tokens": budget.target_tokens if budget is not None else None,
+            }
+        )
+        if reply is None:
+            return None
+        result, report = reply
+        if (local := current_report()) is not None:
+            local.events.extend(report.events)
+        if budget is not None:
+            budget.finished = not report.partial
+        return result
+
+    async def _acompress(
+        self, prompt: str, attempts: int, budget: Optional[Budget] = None
+    ) -> str:
+        if self.daemon is not None:
+            started = time.monotonic()
+            result = await self._acompress_remote(prompt, attempts, budget)
+            if result is not None:
+                return result
+            if budget is not None and budget.deadline is not None:
+                # Time spent waiting on the daemon comes out of the deadline.
+                elapsed = time.monotonic() - started
+                budget.deadline = max(0.0, budget.deadline - elapsed)
+        try:
+            if budget is not None:
+                return await self._compress_bounded(prompt, attempts, budget)
+            return await self._compress_any(prompt, attempts)
+        except Exception:
+            logger.exception("Compression failed, using original prompt")
             return prompt
 
-    def compress(self, prompt: str, attempts: int = 3) -> str:
-        return asyncio.run(self.acompress(prompt, attempts))
+    async def _admit(self, prompt: str) -> Optional[Admission]:
+        if self.admission is None:
+            return None
+        admission = await self.admission.admit(
+            self.cache_tag("_compress"),
+            prompt,
+            self.model.model_name,
+            self.complex,
+            self.minimize,
+        )
+        if admission.decision != "compress":
+            logger.info(
+                "Not compressing (%s): ~%d tks saved per use, ~%.0f tks to compress",
+                admission.decision,
+                admission.savings,
+                admission.cost,
+            )
+        return admission
+
+    async def acompress_with_report(
+        self,
+        prompt: str,
+        attempts: int = 3,
+        deadline: Optional[float] = None,
+        target_tokens: Optional[int] = None,
+    ) -> tuple[str, CompressionReport]:
+        budget = None
+        if deadline is not None or target_tokens is not None:
+            budget = Budget(deadline, target_tokens)
+        with prioritized(self.priority):
+            async with self.sessions.scope(), record() as report:
+                admission = await self._admit(prompt)
+                if admission is None or admission.decision == "compress":
+                    result = await self._acompress(prompt, attempts, budget)
+                else:
+                    result, budget = prompt, None
+        report.decision = admission.decision if admission is not None else None
+        report.partial = budget is not None and not budget.finished
+        report.start_tokens = await self._count(prompt)
+        report.end_tokens = await self._count(result)
+        if admission is not None:
+            await self.admission.observe(admission, report, self.complex)
+        for sink in self.metrics:
+            sink.record(report)
+        return result, report
+
+    def compress(
+        self,
+        prompt: str,
+        attempts: int = 3,
+        deadline: Optional[float] = None,
+        target_tokens: Optional[int] = None,
+    ) -> str:
+        return asyncio.run(self.acompress(prompt, attempts, deadline, target_tokens))
+
+    def compress_with_report(
+        self,
+        prompt: str,
+        attempts: int = 3,
+        deadline: Optional[float] = None,
+        target_tokens: Optional[int] = None,
+    ) -> tuple[str, CompressionReport]:
+        return asyncio.run(
+            self.acompress_with_report(prompt, attempts, deadline, target_tokens)
+        )
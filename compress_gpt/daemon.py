@@ -0,0 +1,202 @@
+import asyncio
+import contextlib
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Any, Optional, Union
+
+from compress_gpt import CACHE_DIR
+from compress_gpt.log import logger
+from compress_gpt.serializer import TypedSerializer
+from compress_gpt.tracing import CompressionReport
+from compress_gpt.utils import digest
+
+# Compressors use the daemon when this is set; `compress-gpt serve` listens on
+# it, or on DEFAULT_SOCKET.
+SOCKET = os.getenv("COMPRESS_GPT_SOCKET")
+DEFAULT_SOCKET = CACHE_DIR / "daemon.sock"
+
+# Frames are a 4-byte length followed by a TypedSerializer payload.
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!I")
+MAX_FRAME = 64 * 1024 * 1024
+
+CONNECT_TIMEOUT = 0.5
+RETRY_AFTER = 30.0
+# Without a deadline, a daemon that hasn't replied by then counts as wedged.
+REPLY_TIMEOUT = float(os.getenv("COMPRESS_GPT_DAEMON_TIMEOUT", 5 * 60))
+# With one, it gets this long past the deadline to send its partial result.
+DEADLINE_GRACE = 1.0
+
+_serializer = TypedSerializer()
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Any:
+    (size,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if size > MAX_FRAME:
+        raise ValueError(f"Frame too large: {size} bytes")
+    return _serializer.loads(await reader.readexactly(size))
+
+
+async def write_frame(writer: asyncio.StreamWriter, value: Any) -> None:
+    data = _serializer.dumps(value)
+    writer.write(HEADER.pack(len(data)) + data)
+    await writer.drain()
+
+
+class DaemonClient:
+    def __init__(
+        self,
+        path: Union[str, Path] = DEFAULT_SOCKET,
+        retry_after: float = RETRY_AFTER,
+        reply_timeout: float = REPLY_TIMEOUT,
+    ) -> None:
+        self.path = Path(path)
+        self.retry_after = retry_after
+        self.reply_timeout = reply_timeout
+        self.down_until = 0.0
+
+    def _down(self, error: Exception) -> None:
+        if time.monotonic() >= self.down_until:
+            logger.warning(
+                "Compression daemon at %s unavailable (%r), compressing in-process",
+                self.path,
+                error,
+            )
+        self.down_until = time.monotonic() + self.retry_after
+
+    async def _exchange(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        request: dict,
+    ) -> Any:
+        await write_frame(writer, {"v": PROTOCOL_VERSION, **request})
+        return await read_frame(reader)
+
+    async def compress(self, request: dict) -> Optional[tuple[str, CompressionReport]]:
+        if time.monotonic() < self.down_until:
+            return None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_unix_connection(str(self.path)), CONNECT_TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            self._down(e)
+            return None
+        timeout = self.reply_timeout
+        if (deadline := request.get("deadline")) is not None:
+            timeout = deadline + DEADLINE_GRACE
+        try:
+            reply = await asyncio.wait_for(
+                self._exchange(reader, writer, request), timeout
+            )
+        except (
+            OSError,
+            ValueError,
+            asyncio.IncompleteReadError,
+            asyncio.TimeoutError,
+        ) as e:
+            self._down(e)
+            return None
+        finally:
+            writer.close()
+        if not isinstance(reply, dict) or "result" not in reply:
+            logger.warning("Compression daemon failed: %s", reply)
+            return None
+        return reply["result"], reply["report"]
+
+
+class Daemon:
+    def __init__(self, path: Union[str, Path, None] = None) -> None:
+        self.path = Path(path or SOCKET or DEFAULT_SOCKET)
+        self.compressors: dict[str, Any] = {}
+        self.inflight: dict[str, asyncio.Future] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def _compressor(self, config: dict):
+        from compress_gpt.compress import Compressor
+
+        key = digest(sorted(config.items()))
+        if key not in self.compressors:
+            compressor = Compressor(verbose=False, daemon=None, **config)
+            # Held open so that every request reuses its HTTP connections.
+            self.compressors[key] = await compressor.__aenter__()
+        return self.compressors[key]
+
+    async def _run(self, request: dict) -> dict:
+        compressor = await self._compressor(request["config"])
+        result, report = await compressor.acompress_with_report(
+            request["prompt"],
+            request["attempts"],
+            request["deadline"],
+            request["target_tokens"],
+        )
+        return {"result": result, "report": report}
+
+    async def compress(self, request: dict) -> dict:
+        # Identical requests from different workers share one compression,
+        # which keeps running even if the worker that started it goes away.
+        key = digest(request)
+        if (future := self.inflight.get(key)) is None:
+            future = self.inflight[key] = asyncio.ensure_future(self._run(request))
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                request = await read_frame(reader)
+                if not isinstance(request, dict):
+                    reply = {"error": "unreadable request"}
+                elif request.pop("v", None) != PROTOCOL_VERSION:
+                    reply = {"error": f"expected protocol {PROTOCOL_VERSION}"}
+                else:
+                    try:
+                        reply = await self.compress(request)
+                    except Exception as e:
+                        logger.exception("Compression failed")
+                        reply = {"error": repr(e)}
+                await write_frame(writer, reply)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _running(self) -> bool:
+        try:
+            _, writer = await asyncio.open_unix_connection(str(self.path))
+        except OSError:
+            return False
+        writer.close()
+        return True
+
+    async def start(self) -> None:
+        if self.path.exists():
+            if await self._running():
+                raise RuntimeError(f"A daemon is already listening on {self.path}")
+            self.path.unlink()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.server = await asyncio.start_unix_server(self.handle, path=str(self.path))
+        os.chmod(self.path, 0o600)
+
+    async def aclose(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        for compressor in self.compressors.values():
+            await compressor.__aexit__(None, None, None)
+        self.compressors.clear()
+        with contextlib.suppress(FileNotFoundError):
+            self.path.unlink()
+
+    async def serve(self) -> None:
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.aclose()
@@ -0,0 +1,177 @@
+import difflib
+import json
+import re
+from collections import Counter, defaultdict, deque
+from datetime import timedelta
+from pathlib import Path
+from typing import Iterable, Union
+
+from compress_gpt import get_store
+from compress_gpt.minimize import minimize
+from compress_gpt.utils import CACHE_NAMESPACE, count_tokens, digest
+
+TOKEN = re.compile(r"\w+|[^\w\s]")
+
+# A phrase needs this many verified sightings, mostly rewritten the same way,
+# before it becomes a rule.
+MIN_SUPPORT = 2
+MIN_AGREEMENT = 0.6
+MAX_PHRASE_WORDS = 8
+# Pairs only feed distillation, so old ones are left to expire.
+PAIR_TTL = int(timedelta(days=30).total_seconds())
+
+
+def pair_key(prompt: str) -> str:
+    return f"pair:{digest(prompt)}"
+
+
+async def record_pair(original: str, compressed: str) -> None:
+    await get_store().set(pair_key(original), (original, compressed), ttl=PAIR_TTL)
+
+
+async def load_pairs() -> list[tuple[str, str]]:
+    from compress_gpt.caching import SCAN_BATCH, scan
+
+    store = get_store()
+    keys = [key for _, key in await scan(f"{CACHE_NAMESPACE}:store:pair:*")]
+    pairs = []
+    for i in range(0, len(keys), SCAN_BATCH):
+        values = await store.multi_get(keys[i : i + SCAN_BATCH], namespace="")
+        pairs.extend(pair for pair in values if pair is not None)
+    return pairs
+
+
+def _tokens(text: str) -> list[re.Match]:
+    return list(TOKEN.finditer(text))
+
+
+def _candidates(original: str, compressed: str) -> Iterable[tuple[str, str]]:
+    source, target = _tokens(original), _tokens(compressed)
+    matcher = difflib.SequenceMatcher(
+        None,
+        [m.group().lower() for m in source],
+        [m.group().lower() for m in target],
+        autojunk=False,
+    )
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op != "replace" or i2 - i1 > MAX_PHRASE_WORDS:
+            continue
+        phrase = original[source[i1].start() : source[i2 - 1].end()]
+        replacement = compressed[target[j1].start() : target[j2 - 1].end()]
+        if sum(c.isalpha() for c in phrase) < 4:
+            continue
+        if count_tokens(replacement) < count_tokens(phrase):
+            yield " ".join(phrase.lower().split()), replacement
+
+
+def learn(
+    pairs: Iterable[tuple[str, str]],
+    min_support: int = MIN_SUPPORT,
+    min_agreement: float = MIN_AGREEMENT,
+) -> dict[str, str]:
+    seen: dict[str, Counter] = defaultdict(Counter)
+    for original, compressed in pairs:
+        for phrase, replacement in _candidates(original, compressed):
+            seen[phrase][replacement] += 1
+    rules = {}
+    for phrase, replacements in seen.items():
+        replacement, count = replacements.most_common(1)[0]
+        total = sum(replacements.values())
+        if count >= min_support and count / total >= min_agreement:
+            rules[phrase] = replacement
+    return rules
+
+
+class Automaton:
+    """Aho-Corasick matcher over lowercased text."""
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.out: list[list[int]] = [[]]
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.out[state].append(len(pattern))
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def matches(self, text: str) -> list[tuple[int, int]]:
+        found = []
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            found.extend((i + 1 - length, i + 1) for length in self.out[state])
+        return found
+
+
+def _is_boundary(text: str, i: int) -> bool:
+    return i <= 0 or i >= len(text) or not (text[i - 1].isalnum() and text[i].isalnum())
+
+
+class LocalCompressor:
+    def __init__(self, rules: dict[str, str]) -> None:
+        self.rules = rules
+        self.automaton = Automaton(rules)
+
+    @property
+    def version(self) -> str:
+        return digest(sorted(self.rules.items()))
+
+    @classmethod
+    async def from_cache(
+        cls, min_support: int = MIN_SUPPORT, min_agreement: float = MIN_AGREEMENT
+    ) -> "LocalCompressor":
+        return cls(learn(await load_pairs(), min_support, min_agreement))
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "LocalCompressor":
+        return cls(json.loads(Path(path).read_text()))
+
+    def save(self, path: Union[str, Path]) -> None:
+        Path(path).write_text(json.dumps(self.rules, indent=2, sort_keys=True))
+
+    def rewrite(self, text: str) -> str:
+        # Leftmost-longest, non-overlapping, whole-word matches. Lowercasing
+        # is per character so that offsets line up with the original text.
+        lower = "".join(c.lower() if len(c.lower()) == 1 else c for c in text)
+        spans = sorted(
+            (
+                (start, end)
+                for start, end in self.automaton.matches(lower)
+                if _is_boundary(lower, start) and _is_boundary(lower, end)
+            ),
+            key=lambda span: (span[0], -span[1]),
+        )
+        parts = []
+        position = 0
+        for start, end in spans:
+            if start < position:
+                continue
+            parts.append(text[position:start])
+            parts.append(self.rules[lower[start:end]])
+            position = end
+        parts.append(text[position:])
+        return "".join(parts)
+
+    def compress(self, prompt: str, format: str = "") -> str:
+        rewritten = self.rewrite(prompt)
+        final = minimize(rewritten, format)
+        return final if count_tokens(final) < count_tokens(prompt) else prompt
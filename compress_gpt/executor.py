@@ -0,0 +1,37 @@
+import asyncio
+import functools
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Literal, Optional, TypeVar, Union
+
+T = TypeVar("T")
+
+# Below this many characters of input, the round-trip to a worker costs more
+# than the work it saves.
+MIN_OFFLOAD_WEIGHT = 4096
+
+_executor: Optional[Executor] = None
+
+
+def get_executor() -> Optional[Executor]:
+    return _executor
+
+
+def set_executor(
+    executor: Union[Executor, Literal["thread", "process"], None],
+    max_workers: Optional[int] = None,
+) -> None:
+    global _executor
+    if executor == "thread":
+        executor = ThreadPoolExecutor(max_workers, thread_name_prefix="compress-gpt")
+    elif executor == "process":
+        executor = ProcessPoolExecutor(max_workers)
+    if _executor is not None and _executor is not executor:
+        _executor.shutdown(wait=False)
+    _executor = executor
+
+
+async def offload(fn: Callable[..., T], *args, weight: int = MIN_OFFLOAD_WEIGHT) -> T:
+    if _executor is None or weight < MIN_OFFLOAD_WEIGHT:
+        return fn(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args))
@@ -0,0 +1,81 @@
+import hashlib
+import re
+from typing import Optional
+
+from compress_gpt import get_store
+from compress_gpt.localize import align, source_lines
+from compress_gpt.prompts.compress_chunks import Chunk
+
+BLOCK_SEPARATOR = re.compile(r"\n\s*\n")
+MIN_BLOCK_TOKENS = 32
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+def split_blocks(text: str) -> list[str]:
+    # Every paragraph is its own block, so the same boilerplate hashes the
+    # same no matter what surrounds it. New neighbouring blocks are still
+    # compressed together; see attribute().
+    return [p for p in BLOCK_SEPARATOR.split(text) if p.strip()]
+
+
+def attribute(blocks: list[str], texts: list[str]) -> list[Optional[list[str]]]:
+    # Splits the chunk texts of a compression covering several blocks back
+    # into per-block texts. A block that shares a chunk with a neighbour
+    # can't be stored on its own and comes back as None.
+    lines: list[str] = []
+    block_of: list[int] = []
+    for i, block in enumerate(blocks):
+        block_lines = source_lines(block)
+        lines.extend(block_lines)
+        block_of.extend([i] * len(block_lines))
+    owners: list[set[int]] = [set() for _ in texts]
+    for i, j in zip(block_of, align(lines, texts)):
+        owners[j].add(i)
+
+    result: list[list[str]] = [[] for _ in blocks]
+    shared: set[int] = set()
+    current = 0
+    for text, owner in zip(texts, owners):
+        if len(owner) > 1:
+            shared |= owner
+        # Chunks that own no line stay with the chunk before them.
+        current = min(owner, default=current)
+        result[current].append(text)
+    return [
+        chunk_texts if i not in shared and chunk_texts else None
+        for i, chunk_texts in enumerate(result)
+    ]
+
+
+class FragmentDictionary:
+    def __init__(self, namespace: str = "default") -> None:
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, tag: str, text: str) -> str:
+        digest = hashlib.sha256(f"{tag}\0{normalize(text)}".encode()).hexdigest()
+        return f"fragment:{self.namespace}:{digest}"
+
+    async def get(self, tag: str, text: str) -> Optional[list[Chunk]]:
+        chunks = await get_store().get(self.key(tag, text))
+        if chunks is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return chunks
+
+    async def get_many(self, tag: str, texts: list[str]) -> list[Optional[list[Chunk]]]:
+        if not texts:
+            return []
+        found = await get_store().multi_get([self.key(tag, t) for t in texts])
+        hits = sum(chunks is not None for chunks in found)
+        self.hits += hits
+        self.misses += len(found) - hits
+        return found
+
+    async def put(self, tag: str, text: str, chunks: list[Chunk]) -> None:
+        await get_store().set(self.key(tag, text), chunks)
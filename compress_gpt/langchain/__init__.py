@@ -1,4 +1,5 @@
 from .prompt import (
+    CompressChatPromptTemplate,
     CompressPrompt,
     CompressSimplePrompt,
     CompressSimpleTemplate,
@@ -1,6 +1,17 @@
+import asyncio
+import itertools
+import re
 from functools import cached_property
+from typing import Optional, Union
 
 from langchain import PromptTemplate
+from langchain.prompts.chat import (
+    AIMessagePromptTemplate,
+    BaseMessagePromptTemplate,
+    ChatPromptTemplate,
+    SystemMessagePromptTemplate,
+)
+from langchain.schema import AIMessage, BaseMessage
 from pydantic import BaseModel
 
 from compress_gpt.compress import Compressor
@@ -9,8 +20,21 @@ from compress_gpt.compress import Compressor
 class CompressMixin(BaseModel):
     compressor_kwargs: dict = {}
 
-    def _compress(self, prompt: str):
-        return Compressor(**self.compressor_kwargs).compress(prompt)
+    def _compressor(self, volatile: Optional[list[str]] = None) -> Compressor:
+        kwargs = self.compressor_kwargs
+        if volatile:
+            kwargs = {**kwargs, "volatile": [*kwargs.get("volatile", []), *volatile]}
+        return Compressor(**kwargs)
+
+    def _compress(self, prompt: str, volatile: Optional[list[str]] = None):
+        return self._compressor(volatile).compress(prompt)
+
+    def _volatile(self, variables: list[str], values: dict) -> list[str]:
+        return [
+            re.escape(str(values[name]))
+            for name in variables
+            if str(values.get(name, ""))
+        ]
 
     class Config:
         arbitrary_types_allowed = True
@@ -18,9 +42,13 @@ class CompressMixin(BaseModel):
 
 
 class CompressPrompt(CompressMixin, PromptTemplate):
+    volatile_variables: list[str] = []
+
     def format(self, **kwargs) -> str:
         formatted = super().format(**kwargs)
-        return self._compress(formatted)
+        return self._compress(
+            formatted, self._volatile(self.volatile_variables, kwargs)
+        )
 
 
 class CompressTemplate(CompressMixin, PromptTemplate):
@@ -35,3 +63,42 @@ class CompressSimplePrompt(CompressPrompt):
 
 class CompressSimpleTemplate(CompressTemplate):
     compressor_kwargs = {"complex": False}
+
+
+class CompressChatPromptTemplate(CompressMixin, ChatPromptTemplate):
+    volatile_variables: list[str] = []
+
+    @staticmethod
+    def _compressible(template: Union[BaseMessagePromptTemplate, BaseMessage]) -> bool:
+        # AI messages are examples of model output, so they're left alone.
+        if isinstance(template, (AIMessage, AIMessagePromptTemplate)):
+            return False
+        if isinstance(template, (BaseMessage, SystemMessagePromptTemplate)):
+            return True
+        return not template.input_variables
+
+    async def aformat_messages(self, **kwargs) -> list[BaseMessage]:
+        kwargs = self._merge_partial_and_user_variables(**kwargs)
+        compressor = self._compressor(self._volatile(self.volatile_variables, kwargs))
+
+        async def format(template) -> list[BaseMessage]:
+            if isinstance(template, BaseMessage):
+                messages = [template]
+            else:
+                messages = template.format_messages(
+                    **{k: v for k, v in kwargs.items() if k in template.input_variables}
+                )
+            if not self._compressible(template):
+                return messages
+            return [
+                message.copy(
+                    update={"content": await compressor.acompress(message.content)}
+                )
+                for message in messages
+            ]
+
+        formatted = await asyncio.gather(*[format(t) for t in self.messages])
+        return list(itertools.chain.from_iterable(formatted))
+
+    def format_messages(self, **kwargs) -> list[BaseMessage]:
+        return asyncio.run(self.aformat_messages(**kwargs))
@@ -0,0 +1,133 @@
+import difflib
+import re
+from collections import defaultdict
+from typing import Union
+
+WORD = re.compile(r"[A-Za-z]{3,}|\d+")
+QUOTED = re.compile(r"[\"'`]([^\"'`]{3,})[\"'`]")
+
+
+def features(text: str) -> set[str]:
+    return {w.lower()[:4] for w in WORD.findall(text)}
+
+
+def source_lines(prompt: str) -> list[str]:
+    return [line for line in prompt.splitlines() if line.strip()]
+
+
+def _score(a: set[str], b: set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a)
+
+
+def align(lines: list[str], texts: list[str]) -> list[int]:
+    if not texts:
+        return [-1] * len(lines)
+    chunk_features = [features(t) for t in texts]
+    best = [0.0] * len(texts)
+    back: list[list[int]] = []
+    for line in lines:
+        scores = [_score(features(line), f) for f in chunk_features]
+        prefix, arg, row, nxt = float("-inf"), 0, [], []
+        for j, score in enumerate(scores):
+            if best[j] > prefix:
+                prefix, arg = best[j], j
+            nxt.append(prefix + score)
+            row.append(arg)
+        best = nxt
+        back.append(row)
+
+    owner = [0] * len(lines)
+    j = max(range(len(texts)), key=lambda k: best[k])
+    for i in reversed(range(len(lines))):
+        owner[i] = j
+        j = back[i][j]
+    return owner
+
+
+def spans(owner: list[int], count: int) -> list[tuple[int, int]]:
+    result = [(-1, -1)] * count
+    for i, j in enumerate(owner):
+        if j < 0:
+            continue
+        start, end = result[j]
+        result[j] = (i if start < 0 else start, i + 1)
+    return result
+
+
+def locate(discrepancy: str, lines: list[str], limit: int = 3) -> list[int]:
+    quoted = [q.lower() for q in QUOTED.findall(discrepancy)]
+    wanted = features(discrepancy)
+    scores = []
+    for i, line in enumerate(lines):
+        score = len(wanted & features(line)) / (len(wanted) or 1)
+        if any(q in line.lower() for q in quoted):
+            score += 1
+        scores.append((score, i))
+    top = max((s for s, _ in scores), default=0)
+    if top <= 0:
+        return []
+    ranked = sorted((s, i) for s, i in scores if s >= top / 2)
+    return sorted(i for _, i in ranked[-limit:])
+
+
+def localize(
+    discrepancies: list[str], lines: list[str], owner: list[int]
+) -> dict[int, list[str]]:
+    targets: dict[int, list[str]] = defaultdict(list)
+    for discrepancy in discrepancies:
+        chunks = {owner[i] for i in locate(discrepancy, lines) if owner[i] >= 0}
+        if not chunks:
+            return {}
+        for chunk in sorted(chunks):
+            targets[chunk].append(discrepancy)
+    return dict(targets)
+
+
+def patch(
+    old: list[str], new: list[str], owner: list[int], count: int, invalid: set[int]
+) -> list[Union[int, str]]:
+    matcher = difflib.SequenceMatcher(
+        None,
+        [" ".join(line.split()) for line in old],
+        [" ".join(line.split()) for line in new],
+        autojunk=False,
+    )
+    mapped: list[int] = [-1] * len(new)
+    moved: dict[int, int] = {}
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            for k in range(i2 - i1):
+                mapped[j1 + k] = i1 + k
+                moved[i1 + k] = j1 + k
+
+    # A chunk survives only if every line it owns is still present and its
+    # lines are still contiguous in the new prompt.
+    kept = set(range(count)) - invalid
+    for j, (start, end) in enumerate(spans(owner, count)):
+        if start < 0:
+            continue
+        positions = [moved.get(i, -1) for i in range(start, end)]
+        if -1 in positions or positions != list(
+            range(positions[0], positions[0] + len(positions))
+        ):
+            kept.discard(j)
+
+    owned = {j for j in owner if j >= 0}
+    plan: list[Union[int, str]] = []
+    emitted = -1
+    for k, line in enumerate(new):
+        j = owner[mapped[k]] if mapped[k] >= 0 else -1
+        if j in kept:
+            if j > emitted:
+                plan.extend(
+                    o for o in range(emitted + 1, j) if o not in owned and o in kept
+                )
+                plan.append(j)
+                emitted = j
+        elif plan and isinstance(plan[-1], str):
+            plan[-1] += "\n" + line
+        else:
+            plan.append(line)
+    return plan
@@ -0,0 +1,46 @@
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Optional
+
+from rich.logging import RichHandler
+
+logger = logging.getLogger("compress_gpt")
+logger.addHandler(logging.NullHandler())
+
+_listener: Optional[QueueListener] = None
+_handler: Optional[QueueHandler] = None
+
+
+def enable_logging(
+    handler: Optional[logging.Handler] = None, level: int = logging.INFO
+) -> None:
+    global _listener, _handler
+    if _listener is not None:
+        if handler is None:
+            return
+        disable_logging()
+
+    queue: SimpleQueue = SimpleQueue()
+    _listener = QueueListener(
+        queue,
+        handler or RichHandler(show_time=False, show_path=False),
+        respect_handler_level=True,
+    )
+    _handler = QueueHandler(queue)
+    _listener.start()
+    logger.addHandler(_handler)
+    logger.setLevel(level)
+
+
+def disable_logging() -> None:
+    global _listener, _handler
+    if _listener is None:
+        return
+    logger.removeHandler(_handler)
+    _listener.stop()
+    _listener = _handler = None
+
+
+atexit.register(disable_logging)
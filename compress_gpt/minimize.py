@@ -0,0 +1,106 @@
+import re
+
+from pydantic import BaseModel
+
+from compress_gpt.utils import count_tokens
+
+# The first entry of each list is the original wording; the others say the
+# same thing in fewer characters. Which one is cheapest depends on the
+# tokenizer and on what surrounds it, so every choice is measured.
+PREAMBLES = [
+    "Below are instructions that you compressed. Decompress & follow them. Don't print the decompressed instructions. Do not ask me for further input before that.",
+    "Below are instructions you compressed. Decompress & follow them. Don't print the decompressed instructions or ask me for input first.",
+    "Instructions you compressed are below. Decompress & follow them; don't print them or ask for input first.",
+]
+FORMAT_PREAMBLES = [
+    "You MUST respond to me using the below format. You are not permitted to deviate from it.",
+    "You MUST respond using the below format, without deviating from it.",
+    "You MUST respond in the below format, without deviation.",
+]
+FORMAT_SUFFIXES = [
+    "Begin! Remember to use the above format.",
+    "Begin! Use the above format.",
+]
+FENCES = [
+    ("```start,name={name}", "```end,name={name}"),
+    ("```{name}", "```"),
+    ("<{name}>", "</{name}>"),
+]
+SEPARATORS = ["\n\n", "\n"]
+
+BLANK_LINES = re.compile(r"\n{3,}")
+TRAILING_SPACE = re.compile(r"[ \t]+$", re.MULTILINE)
+
+
+class Style(BaseModel):
+    preamble: int = 0
+    fence: int = 0
+    separator: int = 0
+    format_preamble: int = 0
+    format_suffix: int = 0
+    tidy: bool = False
+
+    class Config:
+        frozen = True
+
+
+OPTIONS: list[tuple[str, list]] = [
+    ("tidy", [False, True]),
+    ("fence", list(range(len(FENCES)))),
+    ("preamble", list(range(len(PREAMBLES)))),
+    ("separator", list(range(len(SEPARATORS)))),
+    ("format_preamble", list(range(len(FORMAT_PREAMBLES)))),
+    ("format_suffix", list(range(len(FORMAT_SUFFIXES)))),
+]
+
+
+def tidy(text: str) -> str:
+    return BLANK_LINES.sub("\n\n", TRAILING_SPACE.sub("", text))
+
+
+def _fenced(text: str, name: str, fence: int) -> str:
+    start, end = FENCES[fence]
+    return f"\n{start.format(name=name)}\n{text}\n{end.format(name=name)}"
+
+
+def valid(style: Style, instructions: str, format: str) -> bool:
+    # A fence is only usable when its closing marker can't appear in the body.
+    _, end = FENCES[style.fence]
+    return style.fence == 0 or not any(
+        end.format(name=name) in text
+        for name, text in (("INSTRUCTIONS", instructions), ("FORMAT", format))
+    )
+
+
+def render(instructions: str, format: str, style: Style = Style()) -> str:
+    if style.tidy:
+        instructions, format = tidy(instructions), tidy(format)
+    prompt = PREAMBLES[style.preamble] + _fenced(
+        instructions, "INSTRUCTIONS", style.fence
+    )
+    if format:
+        prompt += (
+            SEPARATORS[style.separator]
+            + FORMAT_PREAMBLES[style.format_preamble]
+            + "\n"
+            + _fenced(format, "FORMAT", style.fence)
+            + "\n"
+            + FORMAT_SUFFIXES[style.format_suffix]
+        )
+    return prompt
+
+
+def minimize(instructions: str, format: str) -> str:
+    style = Style()
+    best = count_tokens(render(instructions, format, style))
+    for field, values in OPTIONS:
+        if not format and field in ("separator", "format_preamble", "format_suffix"):
+            continue
+        for value in values:
+            candidate = style.copy(update={field: value})
+            if candidate == style or not valid(candidate, instructions, format):
+                continue
+            tokens = count_tokens(render(instructions, format, candidate))
+            if tokens < best:
+                style, best = candidate, tokens
+    return render(instructions, format, style)
@@ -0,0 +1,102 @@
+import functools
+import re
+from typing import Optional, Type
+
+from compress_gpt import get_store
+from compress_gpt.prompts import Prompt
+from compress_gpt.prompts.compare_prompts import ComparePrompts
+from compress_gpt.prompts.compress_chunks import CompressChunks
+from compress_gpt.prompts.decompress import Decompress
+from compress_gpt.prompts.diff_prompts import DiffPrompts
+from compress_gpt.prompts.fix import FixPrompt
+from compress_gpt.prompts.fix_chunks import FixChunks
+from compress_gpt.prompts.fix_json import FixJSON
+from compress_gpt.prompts.identify_format import IdentifyFormat
+from compress_gpt.prompts.identify_static import IdentifyStatic
+from compress_gpt.prompts.verify_prompts import VerifyPrompts
+from compress_gpt.routing import TStage
+from compress_gpt.utils import count_tokens
+
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4097,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+DEFAULT_WINDOW = 4097
+CONTEXT_ERROR = re.compile(r"maximum context length is (\d+) tokens")
+
+STAGE_PROMPTS: dict[TStage, Type[Prompt]] = {
+    "format": IdentifyFormat,
+    "static": IdentifyStatic,
+    "chunks": CompressChunks,
+    "decompress": Decompress,
+    "diff": DiffPrompts,
+    "compare": ComparePrompts,
+    "verify": VerifyPrompts,
+    "fix": FixPrompt,
+    "repair": FixChunks,
+    "fix_json": FixJSON,
+}
+
+# How many copies of a segment each stage holds in its context, counting
+# both the request (original, restored, statics...) and the response.
+STAGE_FACTORS: dict[TStage, float] = {
+    "format": 1.5,
+    "static": 1.3,
+    "chunks": 1.8,
+    "decompress": 1.6,
+    "diff": 2.5,
+    "compare": 1.8,
+    "verify": 2.4,
+    "fix": 3.0,
+    "repair": 1.5,
+}
+
+
+@functools.cache
+def overhead(stage: TStage) -> int:
+    template = STAGE_PROMPTS[stage].get_prompt()
+    return count_tokens(
+        template.format_prompt(**{v: "" for v in template.input_variables}).to_string()
+    )
+
+
+class ModelRegistry:
+    def __init__(self, windows: Optional[dict[str, int]] = None) -> None:
+        self.windows = {**CONTEXT_WINDOWS, **(windows or {})}
+
+    def register(self, model: str, window: int) -> None:
+        self.windows[model] = window
+
+    async def context_window(self, model: str) -> int:
+        if model in self.windows:
+            return self.windows[model]
+        if learned := await get_store().get(f"context_window:{model}"):
+            self.windows[model] = learned
+            return learned
+        for known in sorted(CONTEXT_WINDOWS, key=len, reverse=True):
+            if model.startswith(known):
+                return CONTEXT_WINDOWS[known]
+        return DEFAULT_WINDOW
+
+    async def learn(self, model: str, error: Exception) -> Optional[int]:
+        if not (match := CONTEXT_ERROR.search(str(error))):
+            return None
+        window = int(match.group(1))
+        self.register(model, window)
+        await get_store().set(f"context_window:{model}", window)
+        return window
+
+    async def fits(self, model: str, tokens: int) -> bool:
+        return tokens <= await self.context_window(model)
+
+    async def segment_size(self, model: str, stages: list[TStage]) -> int:
+        window = await self.context_window(model)
+        return min(
+            int((window - overhead(stage)) / STAGE_FACTORS[stage])
+            for stage in stages
+            if stage in STAGE_FACTORS
+        )
+
+
+registry = ModelRegistry()
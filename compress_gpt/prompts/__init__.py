@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
 from typing import Generic, Optional, Type, cast, get_args
 
+import openai.error
 from langchain import LLMChain
 from langchain.chat_models import ChatOpenAI
 from langchain.prompts import (
@@ -8,6 +9,11 @@ from langchain.prompts import (
 )
 from langchain.schema import BaseLanguageModel
 
+from compress_gpt.executor import offload
+from compress_gpt.scheduler import get_priority, get_scheduler
+from compress_gpt.tracing import current_event
+from compress_gpt.utils import count_tokens
+
 from .output_parser import M, OutputParser
 
 
@@ -22,18 +28,48 @@ class Prompt(ABC, Generic[M]):
         return get_args(cls.__orig_bases__[0])[0]
 
     @classmethod
-    def get_chain(cls, model: Optional[BaseLanguageModel]):
+    def get_chain(
+        cls,
+        model: Optional[BaseLanguageModel],
+        fix_model: Optional[BaseLanguageModel] = None,
+    ):
         model = model or ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo")
         prompt = cls.get_prompt()
         prompt.output_parser = OutputParser[M](
-            pydantic_object=cls.get_format(), model=model
+            pydantic_object=cls.get_format(), model=model, fix_model=fix_model
         )
         return LLMChain(llm=model, prompt=prompt)
 
     @classmethod
-    async def run(cls, model: Optional[BaseLanguageModel] = None, **kwargs):
-        chain = cls.get_chain(model=model)
-        return cast(M, await chain.apredict_and_parse(**kwargs))
+    async def run(
+        cls,
+        model: Optional[BaseLanguageModel] = None,
+        fix_model: Optional[BaseLanguageModel] = None,
+        **kwargs,
+    ):
+        chain = cls.get_chain(model=model, fix_model=fix_model)
+        if (scheduler := get_scheduler()) is None:
+            return await cls._predict_and_parse(chain, **kwargs)
+
+        name = getattr(chain.llm, "model_name", "default")
+        request = chain.prompt.format_prompt(**kwargs).to_string()
+        tokens = await offload(count_tokens, request, weight=len(request))
+        tokens += getattr(chain.llm, "max_tokens", None) or tokens // 2
+        waited = await scheduler.acquire(name, tokens, get_priority())
+        if (event := current_event()) is not None:
+            event.queue_time += waited
+        try:
+            return await cls._predict_and_parse(chain, **kwargs)
+        except openai.error.RateLimitError:
+            scheduler.backoff(name)
+            raise
+
+    @classmethod
+    async def _predict_and_parse(cls, chain: LLMChain, **kwargs):
+        result = await chain.apredict(**kwargs)
+        if (parser := chain.prompt.output_parser) is None:
+            return result
+        return cast(M, await parser.aparse(result))
 
 
 class StrPrompt(Prompt[str]):
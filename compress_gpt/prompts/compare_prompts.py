@@ -7,11 +7,13 @@ from langchain.prompts import (
 )
 from pydantic import BaseModel
 
+from compress_gpt.serializer import register
 from compress_gpt.utils import wrap_prompt
 
 from . import Prompt
 
 
+@register
 class PromptComparison(BaseModel):
     discrepancies: list[str]
     equivalent: bool
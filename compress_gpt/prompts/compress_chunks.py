@@ -9,6 +9,7 @@ from langchain.prompts import (
 )
 from pydantic import BaseModel, Field
 
+from compress_gpt.serializer import register
 from compress_gpt.utils import wrap_prompt
 
 from . import Prompt
@@ -16,6 +17,7 @@ from . import Prompt
 TMode = Literal["c", "r"]
 
 
+@register
 class Chunk(BaseModel):
     text: Optional[str] = Field(None, alias="t")
     target: Optional[int] = Field(None, alias="i")
@@ -72,3 +74,27 @@ class CompressChunks(Prompt[list[Chunk]]):
             "The prompt to chunk is:\n" + wrap_prompt("prompt")
         )
         return ChatPromptTemplate.from_messages([system, human])
+
+
+# Extra guidance for speculative candidates. The first entry is the plain
+# prompt above.
+STRATEGIES = [
+    "",
+    "Prefer symbols, abbreviations and telegraphic style over words wherever the meaning stays exact.",
+    "Restructure the prompt into terse key:value pairs and nested lists.",
+    "Merge overlapping or redundant instructions into one before compressing.",
+]
+
+
+class CompressChunksVariant(CompressChunks):
+    @staticmethod
+    def get_prompt() -> ChatPromptTemplate:
+        prompt = CompressChunks.get_prompt()
+        system = prompt.messages[0].prompt
+        prompt.messages[0].prompt = PromptTemplate(
+            template_format="jinja2",
+            input_variables=[*system.input_variables, "strategy"],
+            template=system.template + "Additional guidance: {{ strategy }}\n",
+        )
+        prompt.input_variables = [*prompt.input_variables, "strategy"]
+        return prompt
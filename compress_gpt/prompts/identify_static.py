@@ -9,11 +9,13 @@ from langchain.prompts import (
 from pydantic import BaseModel
 
 from compress_gpt.prompts.compress_chunks import CompressChunks
+from compress_gpt.serializer import register
 from compress_gpt.utils import wrap_prompt
 
 from . import Prompt
 
 
+@register
 class StaticChunk(BaseModel):
     regex: str
     reason: str
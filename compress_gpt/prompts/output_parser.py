@@ -1,13 +1,15 @@
 import asyncio
 import re
-from typing import Generic, Optional, Type, TypeVar, Union, cast, get_args
+from typing import Any, Generic, Optional, Type, TypeVar, Union, cast, get_args
 
 import dirtyjson
 from langchain.chat_models import ChatOpenAI
 from langchain.output_parsers import PydanticOutputParser
 from pydantic import BaseModel, ValidationError, parse_obj_as, validator
-from rich import print
 
+from compress_gpt.executor import offload
+from compress_gpt.log import logger
+from compress_gpt.tracing import span
 from compress_gpt.utils import make_fast
 
 TModel = TypeVar("TModel", bound=Type[BaseModel])
@@ -16,9 +18,18 @@ TM = Union[TModel, TModelList]
 M = TypeVar("M", bound=TM)
 
 
+def decode(text: str, format: TM) -> tuple[Optional[Any], Optional[str]]:
+    try:
+        parsed = dirtyjson.loads(text, search_for_first_object=True)
+        return parse_obj_as(format, parsed), None
+    except (dirtyjson.Error, ValidationError) as e:
+        return None, str(e)
+
+
 class OutputParser(PydanticOutputParser, Generic[M]):
     format: Optional[M] = None
     model: ChatOpenAI
+    fix_model: Optional[ChatOpenAI] = None
 
     @validator("format", always=True)
     def set_format(cls, _, values: dict) -> Type[BaseModel]:
@@ -41,19 +52,22 @@ class OutputParser(PydanticOutputParser, Generic[M]):
     async def _fix(self, text: str, error: str) -> str:
         from .fix_json import FixJSON
 
-        return await FixJSON.run(model=make_fast(self.model), input=text, error=error)
+        model = self.fix_model or make_fast(self.model)
+        async with span("fix_json", model=model.model_name):
+            return await FixJSON.run(model=model, input=text, error=error)
 
     async def aparse(
         self, text: str, attempts: int = 3
     ) -> Union[BaseModel, list[BaseModel]]:
         for _ in range(attempts):
-            try:
-                text = self._preprocess(text)
-                parsed = dirtyjson.loads(text, search_for_first_object=True)
-                return parse_obj_as(cast(M, self.format), parsed)
-            except (dirtyjson.Error, ValidationError) as e:
-                print(f"[red]Error parsing output: {e}[/red]")
-                text = await self._fix(text, str(e))
+            text = self._preprocess(text)
+            parsed, error = await offload(
+                decode, text, cast(M, self.format), weight=len(text)
+            )
+            if error is None:
+                return parsed
+            logger.warning("Error parsing output: %s", error)
+            text = await self._fix(text, error)
 
         return super().parse(text)
 
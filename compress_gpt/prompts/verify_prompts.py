@@ -0,0 +1,51 @@
+from textwrap import dedent
+
+from langchain.prompts import (
+    ChatPromptTemplate,
+    HumanMessagePromptTemplate,
+    SystemMessagePromptTemplate,
+)
+
+from compress_gpt.utils import wrap_prompt
+
+from . import Prompt
+from .compare_prompts import PromptComparison
+
+
+class VerifyPrompts(Prompt[PromptComparison]):
+    @staticmethod
+    def get_prompt() -> ChatPromptTemplate:
+        system = SystemMessagePromptTemplate.from_template(
+            dedent(
+                """
+            Inputs: original prompt, restored prompt, formatting instructions
+            Task: Determine if restored is semantically equivalent to original
+
+            Compare the two prompts across these areas:
+            - The intent of the task to perform
+            - Factual information provided
+            - Instructions to follow
+            - The specifc tools available, and how exactly to use them
+            - The input and output, focusing on the schema and format
+            - Conditions and constraints
+
+            Semantic equivalence means GPT-4 performs the same task with both prompts.
+            Differences in clarity, conciseness, or wording are not relevant, UNLESS they imply a functional difference.
+            Differences in specificity that would generate a different result are discrepancies, and should be noted.
+            Additional formatting instructions are provided. If these resolve a discrepancy, then do not include it.
+            Do not include diffs that are inconsequential to the task at hand, such as using abbreviations.
+            Use SPECIFIC wording for each discrepancy.
+
+            Return your answer as a JSON object with the following schema:
+            {{"discrepancies": [string], "equivalent": bool}}
+        """
+            )
+        )
+        human = HumanMessagePromptTemplate.from_template(
+            wrap_prompt("original")
+            + "\n\n"
+            + wrap_prompt("restored")
+            + "\n\n"
+            + wrap_prompt("formatting")
+        )
+        return ChatPromptTemplate.from_messages([system, human])
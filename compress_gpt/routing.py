@@ -0,0 +1,66 @@
+from typing import Literal, Optional, Union
+
+from pydantic import BaseModel
+
+TStage = Literal[
+    "format",
+    "static",
+    "chunks",
+    "decompress",
+    "diff",
+    "compare",
+    "verify",
+    "fix",
+    "repair",
+    "fix_json",
+]
+
+FAST_MODEL = "gpt-3.5-turbo"
+
+
+class Route(BaseModel):
+    # None routes to the Compressor's model, unless fast is set.
+    model: Optional[str] = None
+    fast: bool = False
+    timeout: int = 60 * 5
+    max_tokens: Optional[int] = None
+
+    def model_name(self, default: str) -> str:
+        if self.model:
+            return self.model
+        if self.fast and "turbo" not in default:
+            return FAST_MODEL
+        return default
+
+    def key(self, default: str) -> str:
+        return f"{self.model_name(default)}:{self.max_tokens}"
+
+
+DEFAULT_ROUTES: dict[TStage, Route] = {
+    "format": Route(fast=True, timeout=60),
+    "static": Route(),
+    "chunks": Route(),
+    "decompress": Route(fast=True, timeout=60 * 2),
+    "diff": Route(fast=True, timeout=60 * 2),
+    "compare": Route(timeout=60 * 2, max_tokens=1024),
+    "verify": Route(timeout=60 * 2, max_tokens=1024),
+    "fix": Route(),
+    "repair": Route(),
+    "fix_json": Route(fast=True, timeout=60),
+}
+
+TRouteOverride = Union[Route, dict]
+
+
+def make_routes(
+    overrides: Optional[dict[TStage, TRouteOverride]] = None
+) -> dict[TStage, Route]:
+    routes = dict(DEFAULT_ROUTES)
+    for stage, override in (overrides or {}).items():
+        if stage not in DEFAULT_ROUTES:
+            raise ValueError(f"Unknown stage: {stage}")
+        if isinstance(override, Route):
+            routes[stage] = override
+        else:
+            routes[stage] = Route(**{**routes[stage].dict(), **override})
+    return routes
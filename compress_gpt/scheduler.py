@@ -0,0 +1,135 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Optional
+
+from pydantic import BaseModel
+
+POLL_INTERVAL = 0.05
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    DEFAULT = 5
+    BACKGROUND = 10
+
+
+class Limits(BaseModel):
+    rpm: int
+    tpm: int
+    # How many seconds of quota may be spent in a single burst.
+    burst_seconds: float = 60
+
+
+DEFAULT_LIMITS = {
+    "gpt-4": Limits(rpm=200, tpm=40_000),
+    "gpt-4-32k": Limits(rpm=200, tpm=80_000),
+    "gpt-3.5-turbo": Limits(rpm=3_500, tpm=90_000),
+}
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst_seconds: float) -> None:
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    def drain(self, seconds: float) -> None:
+        self._refill()
+        self.level = min(self.level, 0) - seconds * self.rate
+
+
+class _ModelState:
+    def __init__(self, limits: Limits) -> None:
+        self.requests = TokenBucket(limits.rpm, limits.burst_seconds)
+        self.tokens = TokenBucket(limits.tpm, limits.burst_seconds)
+        self.waiters: list[tuple[int, int]] = []
+
+
+class Scheduler:
+    def __init__(
+        self,
+        limits: Optional[dict[str, Limits]] = None,
+        default: Limits = Limits(rpm=200, tpm=40_000),
+    ) -> None:
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.default = default
+        self._states: dict[str, _ModelState] = {}
+        self._seq = itertools.count()
+
+    def _state(self, model: str) -> _ModelState:
+        if model not in self._states:
+            self._states[model] = _ModelState(self.limits.get(model, self.default))
+        return self._states[model]
+
+    async def acquire(
+        self, model: str, tokens: int, priority: Priority = Priority.DEFAULT
+    ) -> float:
+        state = self._state(model)
+        entry = (int(priority), next(self._seq))
+        heapq.heappush(state.waiters, entry)
+        start = time.monotonic()
+        try:
+            while True:
+                if state.waiters[0] != entry:
+                    await asyncio.sleep(POLL_INTERVAL)
+                    continue
+                delay = max(state.requests.delay(1), state.tokens.delay(tokens))
+                if delay <= 0:
+                    state.requests.take(1)
+                    state.tokens.take(tokens)
+                    return time.monotonic() - start
+                await asyncio.sleep(min(delay, POLL_INTERVAL * 10))
+        finally:
+            state.waiters.remove(entry)
+            heapq.heapify(state.waiters)
+
+    def backoff(self, model: str, seconds: float = 10) -> None:
+        state = self._state(model)
+        state.requests.drain(seconds)
+        state.tokens.drain(seconds)
+
+
+_scheduler: Optional[Scheduler] = Scheduler()
+_priority: ContextVar[Priority] = ContextVar("priority", default=Priority.DEFAULT)
+
+
+def get_scheduler() -> Optional[Scheduler]:
+    return _scheduler
+
+
+def set_scheduler(scheduler: Optional[Scheduler]) -> None:
+    global _scheduler
+    _scheduler = scheduler
+
+
+def get_priority() -> Priority:
+    return _priority.get()
+
+
+@contextmanager
+def prioritized(priority: Priority):
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
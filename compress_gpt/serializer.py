@@ -0,0 +1,122 @@
+import json
+import zlib
+from typing import Any, Optional, Type, TypeVar
+
+from aiocache.serializers import BaseSerializer
+from pydantic import BaseModel
+
+from compress_gpt.log import logger
+from compress_gpt.utils import digest
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+M = TypeVar("M", bound=Type[BaseModel])
+
+CONTAINERS = (list, dict)
+
+# One leading byte says how the JSON body is stored. Anything else (e.g. an
+# old pickle, which starts with 0x80) is treated as a cache miss.
+RAW, ZLIB, ZSTD = b"j", b"z", b"s"
+# Bodies at least this large are compressed, favouring speed over ratio.
+COMPRESS_MIN_BYTES = 1024
+ZLIB_LEVEL = 1
+
+# Only registered models can be revived, so a shared cache can't smuggle in
+# arbitrary objects the way a pickle can. Models are stored as a list of
+# field values under a tag that changes whenever the fields do, so entries
+# written by an older schema read as misses.
+MODELS: dict[str, tuple[Type[BaseModel], list[str]]] = {}
+TAGS: dict[type, str] = {}
+
+
+def register(model: M) -> M:
+    fields = list(model.__fields__)
+    tag = f"{model.__name__}.{digest(fields)[:6]}"
+    MODELS[tag] = (model, fields)
+    TAGS[model] = tag
+    return model
+
+
+def _default(value: Any) -> Any:
+    # Everything but models is JSON already; tuples come back as lists.
+    if (tag := TAGS.get(type(value))) is None:
+        raise TypeError(f"Can't cache values of type {type(value).__name__}")
+    return {"$m": tag, "v": [value.__dict__[f] for f in MODELS[tag][1]]}
+
+
+def _revive(value: Any) -> Any:
+    if type(value) is list:
+        return [_revive(v) if type(v) in CONTAINERS else v for v in value]
+    if "$m" not in value:
+        return {k: _revive(v) if type(v) in CONTAINERS else v for k, v in value.items()}
+    model, fields = MODELS[value["$m"]]
+    values = value["v"]
+    if len(values) != len(fields):
+        raise ValueError(f"Malformed {model.__name__}")
+    # Restore the fields the way pickle does, without re-validating them.
+    instance = model.__new__(model)
+    instance.__setstate__(
+        {
+            "__dict__": dict(
+                zip(
+                    fields, [_revive(v) if type(v) in CONTAINERS else v for v in values]
+                )
+            ),
+            "__fields_set__": set(fields),
+        }
+    )
+    return instance
+
+
+def _dumps(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value, default=_default)
+    return json.dumps(value, default=_default, separators=(",", ":")).encode()
+
+
+def _loads(data: bytes) -> Any:
+    value = orjson.loads(data) if orjson is not None else json.loads(data)
+    return _revive(value) if type(value) in CONTAINERS else value
+
+
+class TypedSerializer(BaseSerializer):
+    DEFAULT_ENCODING = None
+
+    def __init__(self, *args, compress_min_bytes: int = COMPRESS_MIN_BYTES, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compress_min_bytes = compress_min_bytes
+
+    def dumps(self, value: Any) -> bytes:
+        body = _dumps(value)
+        if len(body) < self.compress_min_bytes:
+            return RAW + body
+        if zstandard is not None:
+            return ZSTD + zstandard.ZstdCompressor().compress(body)
+        return ZLIB + zlib.compress(body, ZLIB_LEVEL)
+
+    def loads(self, value: Optional[bytes]) -> Any:
+        if value is None:
+            return None
+        codec, body = value[:1], value[1:]
+        try:
+            if codec == ZLIB:
+                body = zlib.decompress(body)
+            elif codec == ZSTD:
+                if zstandard is None:
+                    logger.warning("Skipping a zstd cache entry: zstandard is missing")
+                    return None
+                body = zstandard.ZstdDecompressor().decompress(body)
+            elif codec != RAW:
+                return None
+            return _loads(body)
+        except Exception as e:
+            logger.warning("Skipping an unreadable cache entry: %s", e)
+            return None
@@ -0,0 +1,69 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import aiohttp
+import openai
+from pydantic import BaseModel
+
+from compress_gpt.tracing import current_event
+
+
+class HTTPLimits(BaseModel):
+    connections: int = 100
+    connections_per_host: int = 32
+    keepalive_timeout: float = 30.0
+
+
+async def _on_connection_create(session, context, params) -> None:
+    if (event := current_event()) is not None:
+        event.connections_opened += 1
+
+
+async def _on_connection_reuse(session, context, params) -> None:
+    if (event := current_event()) is not None:
+        event.connections_reused += 1
+
+
+class SessionPool:
+    def __init__(self, limits: HTTPLimits = HTTPLimits()) -> None:
+        self.limits = limits
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._users = 0
+
+    def _open(self) -> aiohttp.ClientSession:
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(_on_connection_create)
+        trace.on_connection_reuseconn.append(_on_connection_reuse)
+        connector = aiohttp.TCPConnector(
+            limit=self.limits.connections,
+            limit_per_host=self.limits.connections_per_host,
+            keepalive_timeout=self.limits.keepalive_timeout,
+        )
+        return aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+
+    async def __aenter__(self) -> "SessionPool":
+        if self.session is None or self.session.closed:
+            self.session = self._open()
+        self._users += 1
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self._users -= 1
+        if self._users == 0:
+            await self.aclose()
+
+    @asynccontextmanager
+    async def scope(self) -> AsyncIterator[aiohttp.ClientSession]:
+        # openai reads the session from a context variable, so every call
+        # made below here (and in tasks started from here) uses it.
+        async with self:
+            token = openai.aiosession.set(self.session)
+            try:
+                yield self.session
+            finally:
+                openai.aiosession.reset(token)
+
+    async def aclose(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
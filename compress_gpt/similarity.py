@@ -0,0 +1,91 @@
+import hashlib
+import random
+from typing import Any, Optional
+
+from compress_gpt import get_store
+from compress_gpt.fragments import normalize
+
+PRIME = (1 << 61) - 1
+NUM_PERM = 64
+BANDS = 16
+SHINGLE = 3
+
+_rng = random.Random(0)
+PERMUTATIONS = [
+    (_rng.randrange(1, PRIME), _rng.randrange(0, PRIME)) for _ in range(NUM_PERM)
+]
+
+
+def shingles(text: str, k: int = SHINGLE) -> set[str]:
+    words = normalize(text).lower().split()
+    if len(words) <= k:
+        return {" ".join(words)}
+    return {" ".join(words[i : i + k]) for i in range(len(words) - k + 1)}
+
+
+def _hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "big")
+
+
+def signature(text: str) -> list[int]:
+    hashes = [_hash(s) for s in shingles(text)]
+    return [min((a * h + b) % PRIME for h in hashes) for a, b in PERMUTATIONS]
+
+
+def similarity(a: list[int], b: list[int]) -> float:
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def bands(sig: list[int]) -> list[str]:
+    rows = len(sig) // BANDS
+    return [
+        hashlib.sha1(repr(sig[i * rows : (i + 1) * rows]).encode()).hexdigest()
+        for i in range(BANDS)
+    ]
+
+
+class NearDuplicateIndex:
+    def __init__(self, namespace: str = "default", threshold: float = 0.7) -> None:
+        self.namespace = namespace
+        self.threshold = threshold
+
+    def _prefix(self, tag: str) -> str:
+        digest = hashlib.sha256(tag.encode()).hexdigest()[:16]
+        return f"near:{self.namespace}:{digest}"
+
+    async def add(self, tag: str, text: str, value: Any) -> None:
+        store = get_store()
+        prefix = self._prefix(tag)
+        sig = signature(text)
+        entry = f"{prefix}:entry:{hashlib.sha256(normalize(text).encode()).hexdigest()}"
+        keys = [f"{prefix}:band:{i}:{band}" for i, band in enumerate(bands(sig))]
+        updates = [
+            (key, [*(entries or []), entry])
+            for key, entries in zip(keys, await store.multi_get(keys))
+            if entry not in (entries or [])
+        ]
+        await store.multi_set([(entry, (sig, value)), *updates])
+
+    async def query(self, tag: str, text: str) -> Optional[tuple[float, Any]]:
+        store = get_store()
+        prefix = self._prefix(tag)
+        sig = signature(text)
+        keys = [f"{prefix}:band:{i}:{band}" for i, band in enumerate(bands(sig))]
+        candidates = list(
+            dict.fromkeys(
+                entry
+                for entries in await store.multi_get(keys)
+                for entry in entries or []
+            )
+        )
+        if not candidates:
+            return None
+
+        best: Optional[tuple[float, Any]] = None
+        for found in await store.multi_get(candidates):
+            if found is None:
+                continue
+            score = similarity(sig, found[0])
+            if score >= self.threshold and (best is None or score > best[0]):
+                best = (score, found[1])
+        return best
@@ -0,0 +1,12 @@
+import pytest
+
+from compress_gpt.scheduler import Scheduler, get_scheduler, set_scheduler
+
+
+@pytest.fixture(autouse=True)
+def fresh_scheduler():
+    # Rate-limit buckets would otherwise carry over from one test to the next.
+    previous = get_scheduler()
+    set_scheduler(Scheduler())
+    yield
+    set_scheduler(previous)
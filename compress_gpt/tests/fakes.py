@@ -0,0 +1,87 @@
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, List, Optional
+
+from aiohttp import web
+from langchain.callbacks.base import BaseCallbackManager
+from langchain.chat_models.base import SimpleChatModel
+from langchain.schema import BaseMessage
+
+
+class FakeChatModel(SimpleChatModel):
+    stage: str = "fake"
+    model_name: str = "fake"
+    handler: Callable[[str, List[BaseMessage]], str]
+    calls: list = []
+
+    def _call(
+        self, messages: List[BaseMessage], stop: Optional[List[str]] = None
+    ) -> str:
+        self.calls.append((self.stage, messages))
+        return self.handler(self.stage, messages)
+
+    async def _agenerate(self, messages, stop=None):
+        return self._generate(messages, stop=stop)
+
+
+def fake_llm(
+    handler: Callable[[str, List[BaseMessage]], str],
+    callback_manager: Optional[BaseCallbackManager] = None,
+):
+    models: dict[str, FakeChatModel] = {}
+    calls: list = []
+
+    def llm(stage: str) -> FakeChatModel:
+        if stage not in models:
+            models[stage] = FakeChatModel(
+                stage=stage,
+                handler=handler,
+                calls=calls,
+                callback_manager=callback_manager,
+            )
+        return models[stage]
+
+    llm.calls = calls
+    return llm
+
+
+@asynccontextmanager
+async def fake_openai(reply: Callable[[dict], str] = lambda body: "ok"):
+    requests: list[tuple[float, dict]] = []
+
+    async def completions(request: web.Request) -> web.Response:
+        body = await request.json()
+        requests.append((time.monotonic(), body))
+        content = reply(body)
+        return web.json_response(
+            {
+                "id": f"chatcmpl-{len(requests)}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 10,
+                    "completion_tokens": 5,
+                    "total_tokens": 15,
+                },
+            }
+        )
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        yield f"http://127.0.0.1:{port}/v1", requests
+    finally:
+        await runner.cleanup()
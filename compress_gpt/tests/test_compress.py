@@ -1,3 +1,4 @@
+import time
 from textwrap import dedent
 
 import dirtyjson
@@ -213,3 +214,44 @@ async def test_output(complex_prompt: str, compressor: Compressor):
     }
     assert original["action"] in CORRECT
     assert compressed["action"] in CORRECT
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fixture", ["simple_prompt", "complex_prompt"])
+async def test_compare_modes(fixture: str, request: pytest.FixtureRequest):
+    prompt = request.getfixturevalue(fixture)
+    compressor = Compressor(verbose=False)
+    format = await compressor._format(prompt)
+    static_chunks = await compressor._extract_statics(
+        prompt, await compressor._static(prompt)
+    )
+    statics = "\n".join(f"- {i}: {chunk}" for i, chunk in enumerate(static_chunks))
+    chunks = await compressor._chunks(prompt, statics)
+    compressed = compressor._reconstruct(static_chunks, format, chunks)
+    restored = await compressor._decompress(compressed, statics)
+
+    results = {}
+    for mode, fast in [
+        ("two_stage", False),
+        ("single_pass", False),
+        ("single_pass", True),
+    ]:
+        compressor = Compressor(verbose=False, compare=mode, fast_compare=fast)
+        compare = (
+            compressor._verify
+            if mode == "single_pass"
+            else compressor._diff_and_compare
+        )
+        start = time.perf_counter()
+        result = await compare(prompt, format, restored, cache_read=False)
+        results[(mode, fast)] = result
+        print(
+            f"[bold]{fixture} {mode}{' (fast)' if fast else ''}[/bold]: "
+            f"{time.perf_counter() - start:0.2f}s, equivalent={result.equivalent}, "
+            f"{len(result.discrepancies)} discrepancies"
+        )
+
+    assert (
+        results[("single_pass", False)].equivalent
+        == results[("two_stage", False)].equivalent
+    )
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+from langchain.chat_models import ChatOpenAI
+
+from compress_gpt import Compressor
+from compress_gpt.prompts.decompress import Decompress
+from compress_gpt.scheduler import (
+    Limits,
+    Priority,
+    Scheduler,
+    get_scheduler,
+    prioritized,
+    set_scheduler,
+)
+from compress_gpt.session import HTTPLimits, SessionPool
+from compress_gpt.tests.fakes import fake_openai
+from compress_gpt.tracing import record, span
+
+
+@pytest.fixture
+def scheduler():
+    previous = get_scheduler()
+    scheduler = Scheduler(
+        limits={"gpt-4": Limits(rpm=600, tpm=1_000_000, burst_seconds=0.1)}
+    )
+    set_scheduler(scheduler)
+    yield scheduler
+    set_scheduler(previous)
+
+
+def make_model(api_base: str) -> ChatOpenAI:
+    return ChatOpenAI(
+        model_name="gpt-4",
+        openai_api_key="sk-test",
+        max_retries=1,
+        model_kwargs={"api_base": api_base},
+    )
+
+
+@pytest.mark.asyncio
+async def test_scheduler_paces_requests(scheduler: Scheduler):
+    async with fake_openai() as (api_base, requests):
+        model = make_model(api_base)
+        async with record() as report:
+            async with span("decompress"):
+                results = await asyncio.gather(
+                    *[
+                        Decompress.run(model=model, compressed="x", statics="")
+                        for _ in range(4)
+                    ]
+                )
+    assert results == ["ok"] * 4
+    times = sorted(t for t, _ in requests)
+    # 10 requests per second with a burst of one request.
+    assert times[-1] - times[0] >= 0.25
+    assert report.events[0].queue_time >= 0.25
+
+
+@pytest.mark.asyncio
+async def test_scheduler_priorities(scheduler: Scheduler):
+    await scheduler.acquire("gpt-4", 1)
+    order = []
+
+    async def request(name: str, priority: Priority):
+        await scheduler.acquire("gpt-4", 1, priority)
+        order.append(name)
+
+    background = asyncio.create_task(request("background", Priority.BACKGROUND))
+    await asyncio.sleep(0.01)
+    interactive = asyncio.create_task(request("interactive", Priority.INTERACTIVE))
+    await asyncio.gather(background, interactive)
+    assert order == ["interactive", "background"]
+
+
+@pytest.mark.asyncio
+async def test_priority_context(scheduler: Scheduler):
+    async with fake_openai() as (api_base, requests):
+        model = make_model(api_base)
+        await scheduler.acquire("gpt-4", 1)
+        order = []
+
+        async def run(name: str, priority: Priority):
+            with prioritized(priority):
+                await Decompress.run(model=model, compressed=name, statics="")
+            order.append(name)
+
+        await asyncio.gather(
+            run("background", Priority.BACKGROUND),
+            run("interactive", Priority.INTERACTIVE),
+        )
+    assert order == ["interactive", "background"]
+
+
+@pytest.mark.asyncio
+async def test_shared_session(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    pool = SessionPool()
+    async with fake_openai() as (api_base, requests):
+        model = make_model(api_base)
+        async with record() as report, pool.scope() as session:
+            for _ in range(3):
+                async with span("decompress"):
+                    await Decompress.run(model=model, compressed="x", statics="")
+            fix = ChatOpenAI(
+                model_name="gpt-3.5-turbo",
+                openai_api_key="sk-test",
+                model_kwargs={"api_base": api_base},
+            )
+            async with span("fix_json"):
+                await Decompress.run(model=fix, compressed="x", statics="")
+    assert len(requests) == 4 and session.closed
+    assert report.connections_opened == 1 and report.connections_reused == 3
+
+    async with Compressor(verbose=False, http=HTTPLimits(connections=4)) as compressor:
+        assert compressor.sessions.session.connector.limit == 4
+        async with compressor.sessions.scope():
+            pass
+        assert not compressor.sessions.session.closed
+    assert compressor.sessions.session is None
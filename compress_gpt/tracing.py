@@ -0,0 +1,300 @@
+import functools
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional, Protocol
+
+from aiocache.plugins import BasePlugin
+from langchain.callbacks.base import BaseCallbackHandler
+from pydantic import BaseModel
+
+from compress_gpt.serializer import register
+from compress_gpt.utils import count_tokens, key_stage
+
+# USD per 1K prompt and completion tokens.
+PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-3.5-turbo": (0.002, 0.002),
+}
+
+
+@register
+class StageEvent(BaseModel):
+    stage: str
+    attempt: int = 0
+    model: Optional[str] = None
+    wall_time: float = 0.0
+    queue_time: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_hit: Optional[bool] = None
+    error: Optional[str] = None
+    connections_opened: int = 0
+    connections_reused: int = 0
+
+    @property
+    def cost(self) -> float:
+        prompt, completion = PRICES.get(self.model or "", (0.0, 0.0))
+        return (self.input_tokens * prompt + self.output_tokens * completion) / 1000
+
+
+@register
+class CompressionReport(BaseModel):
+    events: list[StageEvent] = []
+    start_tokens: int = 0
+    end_tokens: int = 0
+    wall_time: float = 0.0
+    partial: bool = False
+    decision: Optional[str] = None
+
+    @property
+    def input_tokens(self) -> int:
+        return sum(e.input_tokens for e in self.events)
+
+    @property
+    def output_tokens(self) -> int:
+        return sum(e.output_tokens for e in self.events)
+
+    @property
+    def connections_opened(self) -> int:
+        return sum(e.connections_opened for e in self.events)
+
+    @property
+    def connections_reused(self) -> int:
+        return sum(e.connections_reused for e in self.events)
+
+    @property
+    def cost(self) -> float:
+        return sum(e.cost for e in self.events)
+
+    def by_stage(self) -> dict[str, StageEvent]:
+        totals: dict[str, StageEvent] = {}
+        for event in self.events:
+            total = totals.setdefault(event.stage, StageEvent(stage=event.stage))
+            total.wall_time += event.wall_time
+            total.queue_time += event.queue_time
+            total.input_tokens += event.input_tokens
+            total.output_tokens += event.output_tokens
+            total.connections_opened += event.connections_opened
+            total.connections_reused += event.connections_reused
+        return totals
+
+
+_report: ContextVar[Optional[CompressionReport]] = ContextVar("report", default=None)
+_event: ContextVar[Optional[StageEvent]] = ContextVar("event", default=None)
+_attempt: ContextVar[int] = ContextVar("attempt", default=0)
+
+
+def current_event() -> Optional[StageEvent]:
+    return _event.get()
+
+
+def current_report() -> Optional[CompressionReport]:
+    return _report.get()
+
+
+def set_attempt(attempt: int) -> None:
+    _attempt.set(attempt)
+
+
+@asynccontextmanager
+async def record():
+    report = CompressionReport()
+    token = _report.set(report)
+    start = time.perf_counter()
+    try:
+        yield report
+    finally:
+        report.wall_time = time.perf_counter() - start
+        _report.reset(token)
+
+
+@asynccontextmanager
+async def span(stage: str, model: Optional[str] = None):
+    event = StageEvent(stage=stage, attempt=_attempt.get(), model=model)
+    token = _event.set(event)
+    start = time.perf_counter()
+    try:
+        yield event
+    except BaseException as e:
+        event.error = repr(e)
+        raise
+    finally:
+        event.wall_time = time.perf_counter() - start
+        _event.reset(token)
+        if (report := _report.get()) is not None:
+            report.events.append(event)
+
+
+def traced(stage: str):
+    def decorator(f):
+        @functools.wraps(f)
+        async def wrapper(*args, **kwargs):
+            async with span(stage):
+                return await f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Process-wide cache hits and misses per stage.
+cache_counters: dict[str, list[int]] = defaultdict(lambda: [0, 0])
+
+
+class TracingPlugin(BasePlugin):
+    async def post_get(self, client, key, ret=None, namespace=None, **kwargs):
+        stage = key_stage(client.build_key(key, namespace=namespace))
+        cache_counters[stage][0 if ret is not None else 1] += 1
+        if stage == "store":
+            return
+        if (event := current_event()) is not None and event.cache_hit is None:
+            event.cache_hit = ret is not None
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        if (event := current_event()) is not None:
+            event.input_tokens += sum(count_tokens(p) for p in prompts)
+
+    def on_llm_new_token(self, token, **kwargs):
+        if (event := current_event()) is not None:
+            event.output_tokens += 1
+
+    def on_llm_end(self, response, **kwargs):
+        if (event := current_event()) is None:
+            return
+        if usage := (response.llm_output or {}).get("token_usage"):
+            event.output_tokens = max(
+                event.output_tokens, usage.get("completion_tokens", 0)
+            )
+        elif not event.output_tokens:
+            event.output_tokens = sum(
+                count_tokens(g.text) for gs in response.generations for g in gs
+            )
+
+    def on_llm_error(self, error, **kwargs):
+        pass
+
+    def on_chain_start(self, serialized, inputs, **kwargs):
+        pass
+
+    def on_chain_end(self, outputs, **kwargs):
+        pass
+
+    def on_chain_error(self, error, **kwargs):
+        pass
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        pass
+
+    def on_agent_action(self, action, **kwargs):
+        pass
+
+    def on_tool_end(self, output, **kwargs):
+        pass
+
+    def on_tool_error(self, error, **kwargs):
+        pass
+
+    def on_text(self, text, **kwargs):
+        pass
+
+    def on_agent_finish(self, finish, **kwargs):
+        pass
+
+
+class MetricsSink(Protocol):
+    def record(self, report: CompressionReport) -> None:
+        ...
+
+
+class PrometheusMetrics:
+    def __init__(self, prefix: str = "compress_gpt") -> None:
+        self.prefix = prefix
+        self.counters: dict[tuple[str, tuple], float] = defaultdict(float)
+
+    def _inc(self, name: str, value: float, **labels) -> None:
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def record(self, report: CompressionReport) -> None:
+        self._inc("compressions_total", 1)
+        if report.decision is not None:
+            self._inc("admission_decisions_total", 1, decision=report.decision)
+        self._inc("compression_seconds_sum", report.wall_time)
+        self._inc("prompt_tokens_total", report.start_tokens, state="original")
+        self._inc("prompt_tokens_total", report.end_tokens, state="compressed")
+        for event in report.events:
+            self._inc("stage_seconds_sum", event.wall_time, stage=event.stage)
+            self._inc("stage_seconds_count", 1, stage=event.stage)
+            self._inc("stage_queue_seconds_sum", event.queue_time, stage=event.stage)
+            self._inc(
+                "llm_tokens_total", event.input_tokens, stage=event.stage, kind="input"
+            )
+            self._inc(
+                "llm_tokens_total",
+                event.output_tokens,
+                stage=event.stage,
+                kind="output",
+            )
+            self._inc("llm_cost_usd_total", event.cost, stage=event.stage)
+            if event.cache_hit is not None:
+                self._inc(
+                    "cache_requests_total",
+                    1,
+                    stage=event.stage,
+                    result="hit" if event.cache_hit else "miss",
+                )
+            if event.error:
+                self._inc("stage_errors_total", 1, stage=event.stage)
+            for state in ("opened", "reused"):
+                if count := getattr(event, f"connections_{state}"):
+                    self._inc(
+                        "http_connections_total", count, stage=event.stage, state=state
+                    )
+
+    def render(self) -> str:
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(
+                f"{self.prefix}_{name}{{{label_str}}} {value:g}"
+                if label_str
+                else f"{self.prefix}_{name} {value:g}"
+            )
+        return "\n".join(lines) + "\n"
+
+
+class OpenTelemetryMetrics:
+    def __init__(self, meter=None) -> None:
+        try:
+            from opentelemetry import metrics
+        except ImportError:
+            raise ImportError(
+                "OpenTelemetryMetrics requires the opentelemetry-api package."
+            )
+        meter = meter or metrics.get_meter("compress_gpt")
+        self.duration = meter.create_histogram("compress_gpt.stage.duration", unit="s")
+        self.queue = meter.create_histogram("compress_gpt.stage.queue", unit="s")
+        self.tokens = meter.create_counter("compress_gpt.llm.tokens")
+        self.cost = meter.create_counter("compress_gpt.llm.cost", unit="USD")
+        self.cache = meter.create_counter("compress_gpt.cache.requests")
+
+    def record(self, report: CompressionReport) -> None:
+        for event in report.events:
+            attrs = {"stage": event.stage, "attempt": event.attempt}
+            self.duration.record(event.wall_time, attrs)
+            self.queue.record(event.queue_time, attrs)
+            self.tokens.add(event.input_tokens, {**attrs, "kind": "input"})
+            self.tokens.add(event.output_tokens, {**attrs, "kind": "output"})
+            self.cost.add(event.cost, attrs)
+            if event.cache_hit is not None:
+                self.cache.add(
+                    1, {**attrs, "result": "hit" if event.cache_hit else "miss"}
+                )
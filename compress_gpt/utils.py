@@ -1,17 +1,23 @@
+import functools
+import hashlib
+import os
 import sys
 
+import tiktoken
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.chat_models import ChatOpenAI
-from redis import StrictRedis as Redis
 from rich import print
 
+CACHE_NAMESPACE = os.getenv("COMPRESS_GPT_CACHE_NAMESPACE", "compress-gpt")
 
-def has_redis():
-    try:
-        Redis().ping()
-        return True
-    except Exception:
-        return False
+
+@functools.cache
+def _encoding() -> tiktoken.Encoding:
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str) -> int:
+    return len(_encoding().encode(text))
 
 
 def identity(x=None, *args):
@@ -23,8 +29,31 @@ def wrap_prompt(name):
     return f"\n```start,name={upper}\n{{{name}}}\n```end,name={upper}"
 
 
+def digest(value: object) -> str:
+    return hashlib.sha256(str(value).encode()).hexdigest()[:16]
+
+
+def key_stage(key: str) -> str:
+    parts = key.split(":")
+    return parts[1] if len(parts) > 2 and parts[0] == CACHE_NAMESPACE else "unknown"
+
+
+def cache_key(f, self, *args, **kwargs):
+    # <namespace>:<stage>:<digest of the prompt>:<digest of everything else>
+    tag = self.cache_tag(f.__name__) if hasattr(self, "cache_tag") else ""
+    head, rest = (args[0], args[1:]) if args else ("", ())
+    return ":".join(
+        [
+            CACHE_NAMESPACE,
+            f.__name__.lstrip("_"),
+            digest(head),
+            digest(tag + str(rest) + str(sorted(kwargs.items()))),
+        ]
+    )
+
+
 def make_fast(model: ChatOpenAI) -> ChatOpenAI:
-    if "turbo" in model.model_kwargs["model"]:
+    if "turbo" in model.model_name:
         return model
 
     return ChatOpenAI(
@@ -32,7 +61,7 @@ def make_fast(model: ChatOpenAI) -> ChatOpenAI:
         verbose=model.verbose,
         streaming=model.streaming,
         callback_manager=model.callback_manager,
-        model="gpt-3.5-turbo",
+        model_name="gpt-3.5-turbo",
         request_timeout=model.request_timeout,
     )
 
@@ -0,0 +1,28 @@
+import re
+from typing import Optional
+
+PLACEHOLDER = re.compile(r"<<v(\d+)>>")
+
+DATETIME_PATTERNS = [
+    r"\b\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?\b",
+    r"\b\d{1,2}:\d{2}(?::\d{2})?(?:\s*[AaPp][Mm])?\b",
+    r"\b(?:Mon|Tues|Wednes|Thurs|Fri|Satur|Sun)day,? (?:January|February|March|April|May|June|July|August|September|October|November|December) \d{1,2}(?:st|nd|rd|th)?,? \d{4}\b",
+]
+
+
+def extract(prompt: str, patterns: list[str]) -> tuple[str, list[str]]:
+    values: list[str] = []
+
+    def placeholder(match: re.Match) -> str:
+        values.append(match.group(0))
+        return f"<<v{len(values) - 1}>>"
+
+    combined = re.compile("|".join(f"(?:{p})" for p in patterns))
+    return combined.sub(placeholder, prompt), values
+
+
+def splice(compressed: str, values: list[str]) -> Optional[str]:
+    found = sorted(int(i) for i in PLACEHOLDER.findall(compressed))
+    if found != list(range(len(values))):
+        return None
+    return PLACEHOLDER.sub(lambda m: values[int(m.group(1))], compressed)